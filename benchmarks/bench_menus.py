@@ -0,0 +1,128 @@
+"""Микробенчмарк: стоимость подготовки ответа на одно обновление.
+
+Сравнивает старую схему (клавиатура и текст собираются заново на каждое
+обновление, callback_data разбирается цепочкой if/elif) с реестром меню
+из bot.py. Сеть не участвует - измеряется только работа внутри процесса.
+
+Запуск: python benchmarks/bench_menus.py
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+os.environ.setdefault("BOT_TOKEN", "123456:BENCHMARK")
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+import bot
+
+CALLBACKS = ("/start", "/books", "/programs", "/resources")
+USER_NAME = "Фёдор Семёныч"
+
+
+def legacy_render(data, user_name):
+    """Повторяет то, что button_handler делал до реестра меню"""
+    if data == "/start":
+        keyboard = [
+            [InlineKeyboardButton("📚 Книжная библиотека", callback_data="/books")],
+            [InlineKeyboardButton("💻 Программы для ПК", callback_data="/programs")],
+            [InlineKeyboardButton("🔗 Полезные ресурсы", callback_data="/resources")],
+            [InlineKeyboardButton("🔄 Перезапустить бота", callback_data="/start")]
+        ]
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        text = (
+            f"🚀 Привет, {user_name}!\n"
+            "Я Средний Научный Бот канала <b>Республика Информация</b>, Фёдор Семёныч!🤖\n\n"
+            "Используйте команды:\n"
+            "/books - доступ к книжной библиотеке\n"
+            "/programs - программы для ПК\n"
+            "/resources - полезные ресурсы\n"
+            "/help - помощь по боту\n"
+            "/profile - ваш профиль\n\n"
+            "📢 Основной канал: @republic_inform"
+        )
+    elif data == "/books":
+        keyboard = [
+            [InlineKeyboardButton("💻 Программы для ПК", callback_data="/programs")],
+            [InlineKeyboardButton("🔗 Полезные ресурсы", callback_data="/resources")],
+            [InlineKeyboardButton("🔄 Главное меню", callback_data="/start")]
+        ]
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        text = (
+            "📚 <b>Книжный раздел Республика</b>\n\n"
+            "• <a href='https://disk.yandex.ru/d/BX1xA5UCNxz3YA'>Основная библиотека</a> - 5000+ книг\n"
+            "• <a href='https://disk.yandex.ru/d/d5cAK6TBCJSa_Q'>Добавить новую книгу</a> (требуется регистрация)\n"
+            "• <a href='https://disk.yandex.ru/d/BX1xA5UCNxz3YA?sort=modified'>Новинки</a> - последние добавленные книги\n\n"
+            "🔐 <i>Для доступа к книгам требуется пароль от архива</i>\n"
+            "💡 Пароль можно получить в основном канале: @republic_inform"
+        )
+    elif data == "/programs":
+        keyboard = [
+            [InlineKeyboardButton("📚 Книжная библиотека", callback_data="/books")],
+            [InlineKeyboardButton("🔗 Полезные ресурсы", callback_data="/resources")],
+            [InlineKeyboardButton("🔄 Главное меню", callback_data="/start")]
+        ]
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        text = (
+            "💻 <b>Полезные программы для ПК</b>\n\n"
+            "• <a href='https://diakov.net/'>Diakov.net</a> - проверенные программы и репаки\n"
+            "• <a href='https://repack.me/'>Repack.me</a> - репаки игр и программ\n"
+            "• <a href='https://rutracker.org/'>RuTracker</a> - торрент-трекер\n"
+            "• <a href='https://www.softportal.com/'>SoftPortal</a> - софт портал\n\n"
+            "⚠️ <i>Скачивайте программы только из проверенных источников!</i>"
+        )
+    elif data == "/resources":
+        keyboard = [
+            [InlineKeyboardButton("📚 Книжная библиотека", callback_data="/books")],
+            [InlineKeyboardButton("💻 Программы для ПК", callback_data="/programs")],
+            [InlineKeyboardButton("🔄 Главное меню", callback_data="/start")]
+        ]
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        text = (
+            "🔗 <b>Полезные ресурсы</b>\n\n"
+            "🎓 <b>Образование:</b>\n"
+            "• <a href='https://stepik.org/'>Stepik</a> - онлайн-курсы\n"
+            "• <a href='https://openedu.ru/'>Открытое образование</a>\n"
+            "• <a href='https://arzamas.academy/'>Арзамас</a> - гуманитарные курсы\n\n"
+            "📚 <b>Книги:</b>\n"
+            "• <a href='https://flibusta.is/'>Флибуста</a> - электронная библиотека\n"
+            "• <a href='https://libgen.is/'>LibGen</a> - научная литература\n\n"
+            "💻 <b>IT и программирование:</b>\n"
+            "• <a href='https://github.com/'>GitHub</a> - код и проекты\n"
+            "• <a href='https://stackoverflow.com/'>Stack Overflow</a> - помощь программистам\n"
+            "• <a href='https://habr.com/'>Habr</a> - IT-сообщество\n\n"
+            "🛠️ <b>Инструменты:</b>\n"
+            "• <a href='https://notion.so/'>Notion</a> - организация работы\n"
+            "• <a href='https://trello.com/'>Trello</a> - управление проектами"
+        )
+    else:
+        return None
+    return text, reply_markup
+
+
+def registry_render(data, user_name):
+    """Путь через реестр: поиск в словаре и склейка готовых частей"""
+    menu = bot.MENUS.get(data)
+    if menu is None:
+        return None
+    return menu.render(user_name), menu.reply_markup
+
+
+def bench(func, number=20000):
+    """Среднее время одного обновления в микросекундах"""
+    def run():
+        for data in CALLBACKS:
+            func(data, USER_NAME)
+    best = min(timeit.repeat(run, number=number, repeat=5))
+    return best / (number * len(CALLBACKS)) * 1e6
+
+
+if __name__ == "__main__":
+    for data in CALLBACKS:
+        assert legacy_render(data, USER_NAME)[0] == registry_render(data, USER_NAME)[0]
+    before = bench(legacy_render)
+    after = bench(registry_render)
+    print(f"до:    {before:8.3f} мкс/обновление")
+    print(f"после: {after:8.3f} мкс/обновление")
+    print(f"ускорение: x{before / after:.1f}")
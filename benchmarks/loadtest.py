@@ -0,0 +1,386 @@
+"""Нагрузочный тест bot.py с локальной заглушкой Bot API.
+
+Скрипт поднимает заглушку Telegram Bot API (с настраиваемой задержкой
+ответа и долей ответов 429), запускает bot.py отдельным процессом в режиме
+вебхука, направленным на эту заглушку, и с заданной частотой отправляет в
+/webhook синтетические или записанные обновления.
+
+Для каждого сценария выводится:
+- пропускная способность (ответов бота в секунду);
+- p50/p99 времени ответа /webhook;
+- p50/p99 сквозной задержки: от отправки обновления до первого запроса
+  бота к Bot API по этому обновлению;
+- прирост RSS процесса бота;
+- число исходящих вызовов по методам Bot API.
+
+Примеры:
+    python benchmarks/loadtest.py
+    python benchmarks/loadtest.py --rate 500 --duration 20 --api-latency 50
+    python benchmarks/loadtest.py --scenario mixed --error-rate 0.05
+    python benchmarks/loadtest.py --replay updates.jsonl --rate 100
+
+Файл --replay содержит по одному JSON-обновлению Telegram в строке;
+update_id переписываются, чтобы повторы не отсекались дедупликацией.
+
+По умолчанию глобальный лимит отправки бота поднят (--api-rate), чтобы
+измерялся сам бот, а не лимит Telegram в 30 сообщений в секунду.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict, deque
+from urllib.parse import parse_qsl
+
+import httpx
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+TOKEN = "123456:LOADTEST"
+SECRET = "loadtest-secret"
+
+COMMANDS = ("/start", "/books", "/programs", "/resources", "/help", "/settings", "/profile")
+CALLBACKS = ("/start", "/books", "/programs", "/resources")
+
+
+class FakeBotAPI:
+    """Заглушка Bot API: отвечает на методы, которые использует бот, и считает вызовы"""
+
+    def __init__(self, latency: float, error_rate: float):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.calls = Counter()
+        self.webhook_url = ""
+        self.message_ids = itertools.count(1000)
+        # Ожидающие ответа обновления: chat_id -> очередь времен отправки, callback_query_id -> время
+        self.pending_chats: dict[int, deque] = defaultdict(deque)
+        self.pending_callbacks: dict[str, float] = {}
+        self.e2e: list[float] = []
+
+    def reset(self, latency: float, error_rate: float):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.calls.clear()
+        self.e2e = []
+
+    def expect(self, update: dict, sent_at: float):
+        """Запоминает обновление, на которое ждем реакцию бота"""
+        if "callback_query" in update:
+            self.pending_callbacks[update["callback_query"]["id"]] = sent_at
+        elif "message" in update:
+            self.pending_chats[update["message"]["chat"]["id"]].append(sent_at)
+
+    @property
+    def outstanding(self) -> int:
+        return len(self.pending_callbacks) + sum(len(q) for q in self.pending_chats.values())
+
+    def _complete(self, method: str, params: dict):
+        now = time.perf_counter()
+        sent_at = None
+        if method == "answerCallbackQuery":
+            sent_at = self.pending_callbacks.pop(params.get("callback_query_id"), None)
+        elif "chat_id" in params:
+            queue = self.pending_chats.get(int(params["chat_id"]))
+            if queue:
+                sent_at = queue.popleft()
+        if sent_at is not None:
+            self.e2e.append(now - sent_at)
+
+    async def handle(self, request: Request) -> JSONResponse:
+        method = request.path_params["method"]
+        body = await request.body()
+        if request.headers.get("content-type", "").startswith("application/json"):
+            params = json.loads(body or b"{}")
+        else:
+            params = dict(parse_qsl(body.decode()))
+        self.calls[method] += 1
+
+        if method == "getUpdates":
+            await asyncio.sleep(float(params.get("timeout", 0)))
+            return JSONResponse({"ok": True, "result": []})
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.error_rate and method != "getMe" and random.random() < self.error_rate:
+            self.calls["429"] += 1
+            return JSONResponse(
+                {"ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                 "parameters": {"retry_after": 1}},
+                status_code=429,
+            )
+        self._complete(method, params)
+        return JSONResponse({"ok": True, "result": self._result(method, params)})
+
+    def _result(self, method: str, params: dict):
+        if method == "getMe":
+            return {"id": 123456, "is_bot": True, "first_name": "LoadTest", "username": "loadtest_bot",
+                    "can_join_groups": True, "can_read_all_group_messages": False,
+                    "supports_inline_queries": True}
+        if method == "setWebhook":
+            self.webhook_url = params.get("url", "")
+            return True
+        if method == "deleteWebhook":
+            self.webhook_url = ""
+            return True
+        if method == "getWebhookInfo":
+            return {"url": self.webhook_url, "has_custom_certificate": False, "pending_update_count": 0}
+        if method == "copyMessage":
+            return {"message_id": next(self.message_ids)}
+        if method.startswith(("send", "edit")):
+            chat_id = int(params.get("chat_id", 0))
+            return {"message_id": int(params.get("message_id") or next(self.message_ids)),
+                    "date": int(time.time()), "chat": {"id": chat_id, "type": "private"},
+                    "text": params.get("text", "")}
+        return True
+
+    def app(self) -> Starlette:
+        return Starlette(routes=[Route("/bot{token}/{method}", self.handle, methods=["POST", "GET"])])
+
+
+class UpdateFactory:
+    """Синтетические обновления: команды и нажатия кнопок"""
+
+    def __init__(self, users: int):
+        self.users = users
+        self.update_ids = itertools.count(1)
+        self.seq = itertools.count(1)
+
+    def _user(self, n: int) -> dict:
+        user_id = 10_000_000 + (n % self.users if self.users else n)
+        return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"}
+
+    def command(self) -> dict:
+        n = next(self.seq)
+        user = self._user(n)
+        text = random.choice(COMMANDS)
+        return {
+            "update_id": next(self.update_ids),
+            "message": {
+                "message_id": n, "date": int(time.time()), "from": user,
+                "chat": {"id": user["id"], "type": "private"}, "text": text,
+                "entities": [{"type": "bot_command", "offset": 0, "length": len(text)}],
+            },
+        }
+
+    def callback(self) -> dict:
+        n = next(self.seq)
+        user = self._user(n)
+        return {
+            "update_id": next(self.update_ids),
+            "callback_query": {
+                "id": str(n), "from": user, "chat_instance": str(user["id"]),
+                "data": random.choice(CALLBACKS),
+                "message": {"message_id": n, "date": int(time.time()),
+                            "chat": {"id": user["id"], "type": "private"}, "text": "menu"},
+            },
+        }
+
+    def replay(self, updates: list[dict]):
+        """Бесконечный повтор записанных обновлений с новыми update_id"""
+        for update in itertools.cycle(updates):
+            update = dict(update, update_id=next(self.update_ids))
+            if "callback_query" in update:
+                update["callback_query"] = dict(update["callback_query"], id=str(next(self.seq)))
+            yield update
+
+
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def rss_kb(pid: int) -> int:
+    """RSS процесса в КиБ (Linux)"""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+async def run_scenario(name: str, source, api: FakeBotAPI, client: httpx.AsyncClient, bot_url: str,
+                       pid: int, rate: float, duration: float, drain: float) -> dict:
+    """Отправляет обновления с заданной частотой и собирает результаты"""
+    webhook_latency: list[float] = []
+    statuses = Counter()
+    rss_before = rss_kb(pid)
+    calls_before = Counter(api.calls)
+
+    async def post(update: dict):
+        started = time.perf_counter()
+        api.expect(update, started)
+        try:
+            response = await client.post(
+                f"{bot_url}/webhook", json=update,
+                headers={"X-Telegram-Bot-Api-Secret-Token": SECRET},
+            )
+            statuses[response.status_code] += 1
+        except httpx.HTTPError:
+            statuses["error"] += 1
+        webhook_latency.append(time.perf_counter() - started)
+
+    total = int(rate * duration)
+    tasks = []
+    started = time.perf_counter()
+    for i in range(total):
+        delay = started + i / rate - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(post(next(source))))
+    await asyncio.gather(*tasks)
+
+    deadline = time.perf_counter() + drain
+    while api.outstanding and time.perf_counter() < deadline:
+        await asyncio.sleep(0.05)
+    elapsed = time.perf_counter() - started
+
+    calls = Counter(api.calls)
+    calls.subtract(calls_before)
+    return {
+        "scenario": name,
+        "sent": total,
+        "replied": len(api.e2e),
+        "unanswered": api.outstanding,
+        "throughput": len(api.e2e) / elapsed if elapsed else 0.0,
+        "webhook_p50_ms": percentile(webhook_latency, 0.5) * 1000,
+        "webhook_p99_ms": percentile(webhook_latency, 0.99) * 1000,
+        "e2e_p50_ms": percentile(api.e2e, 0.5) * 1000,
+        "e2e_p99_ms": percentile(api.e2e, 0.99) * 1000,
+        "rss_growth_kb": rss_kb(pid) - rss_before,
+        "statuses": {str(k): v for k, v in statuses.items()},
+        "outbound": {k: v for k, v in calls.items() if v},
+    }
+
+
+def print_report(results: list[dict]):
+    header = (f"{'сценарий':<12}{'отпр.':>7}{'ответ.':>8}{'отв/с':>9}"
+              f"{'webhook p50':>13}{'p99':>9}{'e2e p50':>10}{'p99':>9}{'RSS +КиБ':>10}")
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        print(f"{r['scenario']:<12}{r['sent']:>7}{r['replied']:>8}{r['throughput']:>9.1f}"
+              f"{r['webhook_p50_ms']:>13.2f}{r['webhook_p99_ms']:>9.2f}"
+              f"{r['e2e_p50_ms']:>10.2f}{r['e2e_p99_ms']:>9.2f}{r['rss_growth_kb']:>10}")
+    for r in results:
+        calls = ", ".join(f"{k}={v}" for k, v in sorted(r["outbound"].items()))
+        print(f"{r['scenario']}: исходящие вызовы: {calls}; ответы /webhook: {r['statuses']}")
+
+
+async def wait_until_ready(client: httpx.AsyncClient, bot_url: str, api: FakeBotAPI, process, timeout: float):
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"bot.py завершился с кодом {process.returncode}")
+        try:
+            response = await client.get(f"{bot_url}/ready")
+            if response.status_code == 200 and api.webhook_url:
+                return
+        except httpx.HTTPError:
+            pass
+        await asyncio.sleep(0.1)
+    raise RuntimeError("bot.py не запустился вовремя")
+
+
+async def main(args):
+    api = FakeBotAPI(args.api_latency / 1000, 0.0)
+    api_server = uvicorn.Server(uvicorn.Config(api.app(), host="127.0.0.1", port=args.api_port, log_level="warning"))
+    api_task = asyncio.create_task(api_server.serve())
+    while not api_server.started:
+        await asyncio.sleep(0.05)
+
+    workdir = tempfile.mkdtemp(prefix="loadtest-")
+    bot_url = f"http://127.0.0.1:{args.bot_port}"
+    env = dict(
+        os.environ,
+        BOT_TOKEN=TOKEN,
+        PORT=str(args.bot_port),
+        RENDER_EXTERNAL_URL=bot_url,
+        BOT_API_BASE_URL=f"http://127.0.0.1:{args.api_port}/bot",
+        WEBHOOK_SECRET=SECRET,
+        BOT_API_GLOBAL_RATE=str(args.api_rate),
+        FLOOD_RATE=str(args.flood_rate),
+        USER_DB_PATH=os.path.join(workdir, "users.db"),
+        BROADCAST_STATE_PATH=os.path.join(workdir, "broadcast.json"),
+        JOURNAL_DIR=os.path.join(workdir, "journal"),
+    )
+    log = open(os.path.join(workdir, "bot.log"), "w")
+    process = subprocess.Popen([sys.executable, os.path.join(ROOT, "bot.py")], env=env, cwd=workdir,
+                               stdout=log, stderr=subprocess.STDOUT)
+    results = []
+    try:
+        limits = httpx.Limits(max_connections=args.connections, max_keepalive_connections=args.connections)
+        async with httpx.AsyncClient(limits=limits, timeout=30) as client:
+            await wait_until_ready(client, bot_url, api, process, args.startup_timeout)
+            factory = UpdateFactory(args.users)
+            if args.replay:
+                with open(args.replay, encoding="utf-8") as f:
+                    recorded = [json.loads(line) for line in f if line.strip()]
+                scenarios = [("replay", factory.replay(recorded), args.error_rate)]
+            else:
+                sources = {
+                    "commands": lambda: iter(factory.command, None),
+                    "callbacks": lambda: iter(factory.callback, None),
+                    "mixed": lambda: (factory.command() if random.random() < 0.3 else factory.callback()
+                                      for _ in itertools.count()),
+                }
+                names = [args.scenario] if args.scenario != "all" else ["commands", "callbacks", "mixed", "429"]
+                scenarios = []
+                for name in names:
+                    if name == "429":
+                        scenarios.append(("429", sources["mixed"](), args.error_rate or 0.05))
+                    else:
+                        scenarios.append((name, sources[name](), args.error_rate))
+            for name, source, error_rate in scenarios:
+                api.reset(args.api_latency / 1000, error_rate)
+                results.append(await run_scenario(name, source, api, client, bot_url, process.pid,
+                                                  args.rate, args.duration, args.drain))
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+        log.close()
+        api_server.should_exit = True
+        await api_task
+
+    print_report(results)
+    print(f"Лог бота: {os.path.join(workdir, 'bot.log')}")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenario", default="all", choices=["all", "commands", "callbacks", "mixed", "429"])
+    parser.add_argument("--replay", help="файл JSONL с записанными обновлениями")
+    parser.add_argument("--rate", type=float, default=200, help="обновлений в секунду")
+    parser.add_argument("--duration", type=float, default=10, help="длительность сценария, секунд")
+    parser.add_argument("--drain", type=float, default=10, help="сколько ждать оставшиеся ответы, секунд")
+    parser.add_argument("--users", type=int, default=0, help="число разных пользователей (0 - у каждого обновления свой)")
+    parser.add_argument("--api-latency", type=float, default=20, help="задержка ответа заглушки Bot API, мс")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля ответов 429")
+    parser.add_argument("--api-rate", type=float, default=10000, help="BOT_API_GLOBAL_RATE для бота")
+    parser.add_argument("--flood-rate", type=float, default=1000000,
+                        help="FLOOD_RATE для бота (по умолчанию защита от флуда фактически выключена)")
+    parser.add_argument("--connections", type=int, default=100, help="одновременных соединений к /webhook")
+    parser.add_argument("--api-port", type=int, default=18081)
+    parser.add_argument("--bot-port", type=int, default=18080)
+    parser.add_argument("--startup-timeout", type=float, default=30)
+    parser.add_argument("--json", help="сохранить результаты в файл JSON")
+    asyncio.run(main(parser.parse_args()))
@@ -1,12 +1,41 @@
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.ext import (
+    Application, ApplicationHandlerStop, BaseRateLimiter, CommandHandler, CallbackQueryHandler, ContextTypes,
+    InlineQueryHandler, TypeHandler, filters,
+)
+from telegram import (
+    Update, InlineKeyboardButton, InlineKeyboardMarkup, InlineQueryResultArticle, InputTextMessageContent,
+)
+from telegram.constants import ChatMemberStatus, ChatType, ParseMode
+from telegram.error import BadRequest, Forbidden, RetryAfter, TelegramError
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Optional
+import hashlib
+import heapq
+import hmac
+import html
+import importlib
+import itertools
+import json
 import logging
+import mmap
 import os
+import re
+import signal
+import sqlite3
+import struct
+import threading
+import time
+import zlib
 import asyncio
+from bisect import bisect_left
+from contextlib import asynccontextmanager
+from functools import partial
 from starlette.applications import Starlette
 from starlette.routing import Route
 from starlette.requests import Request
-from starlette.responses import Response, PlainTextResponse
+from starlette.responses import Response, PlainTextResponse, JSONResponse
 import uvicorn
 
 # Настройка логов
@@ -15,299 +44,1549 @@ logging.basicConfig(
     level=logging.INFO
 )
 logger = logging.getLogger(__name__)
+# httpx пишет строку в лог на каждый запрос к Bot API
+logging.getLogger("httpx").setLevel(logging.WARNING)
 
 # Настройки вебхука
 # Безопасное получение токена только из переменных окружения
 TOKEN = os.environ["BOT_TOKEN"]
 PORT = int(os.environ.get("PORT", 8000))
-WEBHOOK_URL = os.environ.get("RENDER_EXTERNAL_URL", "") + "/webhook"
+# Адрес Bot API: можно указать локальный сервер Bot API или тестовую заглушку
+BOT_API_BASE_URL = os.environ.get("BOT_API_BASE_URL", "https://api.telegram.org/bot")
+EXTERNAL_URL = os.environ.get("RENDER_EXTERNAL_URL", "")
+# Секрет, который Telegram присылает в заголовке X-Telegram-Bot-Api-Secret-Token.
+# По умолчанию выводится из токена, чтобы не меняться между перезапусками
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET") or hashlib.sha256(TOKEN.encode()).hexdigest()
+# getWebhookInfo не возвращает секрет, поэтому его отпечаток входит в адрес вебхука:
+# совпадение адреса означает и совпадение секрета
+WEBHOOK_URL = (
+    f"{EXTERNAL_URL}/webhook?v={hashlib.sha256(WEBHOOK_SECRET.encode()).hexdigest()[:8]}"
+    if EXTERNAL_URL else ""
+)
+
+# Режим получения обновлений: webhook или polling (без внешнего адреса - polling)
+BOT_MODE = os.environ.get("BOT_MODE") or ("webhook" if WEBHOOK_URL else "polling")
+POLL_BATCH_SIZE = int(os.environ.get("POLL_BATCH_SIZE", 100))  # обновлений за один getUpdates (1-100)
+POLL_TIMEOUT = int(os.environ.get("POLL_TIMEOUT", 30))  # длительность long polling, секунд
+
+# Настройки приема вебхуков
+INGRESS_QUEUE_SIZE = int(os.environ.get("INGRESS_QUEUE_SIZE", 1000))  # верхняя граница очереди
+INGRESS_WORKERS = int(os.environ.get("INGRESS_WORKERS", 4))
+INGRESS_OVERFLOW = os.environ.get("INGRESS_OVERFLOW", "drop")  # drop - подтвердить и отбросить, reject - вернуть 503
+JSON_DECODER = os.environ.get("JSON_DECODER", "auto")  # auto, json, orjson или имя модуля с функцией loads
+DEDUP_WINDOW = int(os.environ.get("DEDUP_WINDOW", 4096))  # сколько последних update_id помнить
+
+# Журнал принятых обновлений (на Render - путь на постоянном диске; пустая строка - выключен)
+JOURNAL_DIR = os.environ.get("JOURNAL_DIR", "journal")
+JOURNAL_SEGMENT_SIZE = int(os.environ.get("JOURNAL_SEGMENT_SIZE", 4 * 1024 * 1024))  # байт в одном сегменте
+JOURNAL_MAX_SEGMENTS = int(os.environ.get("JOURNAL_MAX_SEGMENTS", 4))  # сверх этого старые сегменты уплотняются
+JOURNAL_SYNC_INTERVAL = float(os.environ.get("JOURNAL_SYNC_INTERVAL", 0))  # доп. окно групповой записи, секунд
+
+# Настройки параллельной обработки обновлений
+UPDATE_WORKERS = int(os.environ.get("UPDATE_WORKERS", 8))  # число шардов (воркеров)
+SHARD_QUEUE_SIZE = int(os.environ.get("SHARD_QUEUE_SIZE", 100))  # глубина очереди каждого шарда
+SHARD_DETACH_AFTER = float(os.environ.get("SHARD_DETACH_AFTER", 0.2))  # через сколько секунд долгое обновление освобождает шард
+SHARD_DRAIN_TIMEOUT = float(os.environ.get("SHARD_DRAIN_TIMEOUT", 10))  # сколько ждать очереди шардов при остановке, секунд
+
+# Лимиты Bot API на исходящие сообщения
+BOT_API_GLOBAL_RATE = float(os.environ.get("BOT_API_GLOBAL_RATE", 30))  # сообщений в секунду на бота
+BOT_API_CHAT_RATE = float(os.environ.get("BOT_API_CHAT_RATE", 1))  # сообщений в секунду в личный чат
+BOT_API_GROUP_RATE = float(os.environ.get("BOT_API_GROUP_RATE", 20 / 60))  # сообщений в секунду в группу
+BOT_API_CHAT_BURST = int(os.environ.get("BOT_API_CHAT_BURST", 3))  # допустимый всплеск в одном чате
+BOT_API_MAX_RETRIES = int(os.environ.get("BOT_API_MAX_RETRIES", 3))  # повторов после 429
+
+# Кэш меню, показанных в сообщениях
+MENU_STATE_SIZE = int(os.environ.get("MENU_STATE_SIZE", 10000))  # сколько сообщений помнить
+TAP_COALESCE_WINDOW = float(os.environ.get("TAP_COALESCE_WINDOW", 0.3))  # окно склейки нажатий, секунд
+
+# Каталог ссылок и поиск в inline-режиме
+CATALOG_PATH = os.environ.get("CATALOG_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "catalog.json"))
+INLINE_PAGE_SIZE = int(os.environ.get("INLINE_PAGE_SIZE", 20))  # результатов в одном ответе (не больше 50)
+INLINE_CACHE_SIZE = int(os.environ.get("INLINE_CACHE_SIZE", 1024))  # сколько запросов помнить
+INLINE_CACHE_TIME = int(os.environ.get("INLINE_CACHE_TIME", 300))  # сколько секунд Telegram хранит ответ
+
+# Защита от флуда: лимит обновлений от одного пользователя
+FLOOD_RATE = float(os.environ.get("FLOOD_RATE", 1))  # обновлений в секунду
+FLOOD_BURST = int(os.environ.get("FLOOD_BURST", 5))  # допустимый всплеск
+FLOOD_MAX_DELAY = float(os.environ.get("FLOOD_MAX_DELAY", 0))  # ждать токен не дольше, секунд (0 - сразу отбрасывать)
+
+# Контроль задержки цикла событий
+LOOP_LAG_INTERVAL = float(os.environ.get("LOOP_LAG_INTERVAL", 0.5))  # период замера, секунд
+LOOP_LAG_WARN = float(os.environ.get("LOOP_LAG_WARN", 0.1))  # писать в лог задержки больше этой, секунд
+
+# Хранилище пользователей
+USER_DB_PATH = os.environ.get("USER_DB_PATH", "users.db")
+USER_CACHE_SIZE = int(os.environ.get("USER_CACHE_SIZE", 10000))  # пользователей в памяти
+USER_FLUSH_INTERVAL = float(os.environ.get("USER_FLUSH_INTERVAL", 5))  # секунд между записями на диск
+USER_FLUSH_BATCH = int(os.environ.get("USER_FLUSH_BATCH", 500))  # записать раньше, если накопилось столько изменений
+
+# Рассылка
+ADMIN_IDS = [int(x) for x in os.environ.get("ADMIN_IDS", "").split(",") if x.strip()]
+BROADCAST_STATE_PATH = os.environ.get("BROADCAST_STATE_PATH", "broadcast.json")
+BROADCAST_CONCURRENCY = int(os.environ.get("BROADCAST_CONCURRENCY", 25))  # одновременных отправок
+BROADCAST_REPORT_INTERVAL = float(os.environ.get("BROADCAST_REPORT_INTERVAL", 5))  # секунд между отчетами
+
+# ===== СОСТОЯНИЕ ЗАПУСКА =====
+class BootState:
+    """Этапы запуска для эндпоинта /ready и замер времени до первого ответа"""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.phase = "starting"
+        self.ready_after: Optional[float] = None
+        self.first_reply_after: Optional[float] = None
+        self.webhook = "pending"
+
+    def mark_ready(self):
+        self.phase = "ready"
+        self.ready_after = time.monotonic() - self.started
+        logger.info(f"⏱ Бот готов к обработке через {self.ready_after:.2f} с после запуска")
+
+    def mark_reply(self):
+        """Вызывается после каждого успешного ответа; логирует только первый"""
+        if self.first_reply_after is None:
+            self.first_reply_after = time.monotonic() - self.started
+            logger.info(f"⏱ Первый ответ пользователю через {self.first_reply_after:.2f} с после запуска")
+
+    def as_dict(self) -> dict:
+        return {
+            "state": self.phase,
+            "uptime_s": round(time.monotonic() - self.started, 3),
+            "ready_after_s": self.ready_after,
+            "first_reply_after_s": self.first_reply_after,
+            "webhook": self.webhook,
+        }
+
+boot = BootState()
+
+# ===== МЕТРИКИ =====
+# Границы корзин гистограмм задержки, секунд
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Histogram:
+    """Гистограмма с фиксированными корзинами: запись - это bisect и три сложения"""
+
+    __slots__ = ("counts", "total", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.total += value
+        self.count += 1
+
+
+def escape_label(value) -> str:
+    """Экранирование значения метки Prometheus"""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    """Метки в формате Prometheus: {name="value",...}"""
+    pairs = [f'{name}="{escape_label(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metrics:
+    """Реестр метрик для эндпоинта /metrics в текстовом формате Prometheus.
+
+    Гистограммы и счетчики обновляются на горячем пути, а значения, которые
+    и так хранятся в других объектах (глубина очередей, счетчики приема),
+    собираются функциями-коллекторами только в момент запроса.
+    """
+
+    def __init__(self):
+        self._families: dict[str, tuple] = {}  # имя -> (тип, описание, имена меток)
+        self._histograms: dict[str, dict[tuple, Histogram]] = {}
+        self._counters: dict[str, dict[tuple, float]] = {}
+        self._collectors: dict[str, object] = {}
+
+    def histogram(self, name: str, help_text: str, label_names: tuple = ()):
+        self._families[name] = ("histogram", help_text, label_names)
+        self._histograms[name] = {}
+
+    def counter(self, name: str, help_text: str, label_names: tuple = ()):
+        self._families[name] = ("counter", help_text, label_names)
+        self._counters[name] = {}
+
+    def collected(self, name: str, kind: str, help_text: str, label_names: tuple, collect):
+        """Метрика, значения которой возвращает collect() в виде [(метки, значение)]"""
+        self._families[name] = (kind, help_text, label_names)
+        self._collectors[name] = collect
+
+    def observe(self, name: str, labels: tuple, value: float):
+        series = self._histograms[name]
+        histogram = series.get(labels)
+        if histogram is None:
+            histogram = series[labels] = Histogram()
+        histogram.observe(value)
+
+    def inc(self, name: str, labels: tuple = (), amount: float = 1):
+        series = self._counters[name]
+        series[labels] = series.get(labels, 0) + amount
+
+    def render(self) -> str:
+        lines = []
+        for name, (kind, help_text, label_names) in self._families.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == "histogram":
+                for labels, histogram in self._histograms[name].items():
+                    cumulative = 0
+                    for bound, count in zip(LATENCY_BUCKETS, histogram.counts):
+                        cumulative += count
+                        le = 'le="%s"' % bound
+                        lines.append(f"{name}_bucket{format_labels(label_names, labels, le)} {cumulative}")
+                    le = 'le="+Inf"'
+                    lines.append(f"{name}_bucket{format_labels(label_names, labels, le)} {histogram.count}")
+                    lines.append(f"{name}_sum{format_labels(label_names, labels)} {histogram.total}")
+                    lines.append(f"{name}_count{format_labels(label_names, labels)} {histogram.count}")
+                continue
+            series = self._collectors[name]() if name in self._collectors else self._counters[name].items()
+            for labels, value in series:
+                lines.append(f"{name}{format_labels(label_names, labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+metrics.histogram("bot_handler_duration_seconds", "Время обработчиков команд и кнопок", ("handler",))
+metrics.histogram("bot_webhook_duration_seconds", "Время ответа эндпоинта /webhook")
+metrics.histogram("bot_api_request_duration_seconds", "Время запросов к Bot API", ("method",))
+metrics.histogram("bot_api_queue_delay_seconds", "Задержка, добавленная планировщиком отправки", ("method",))
+metrics.counter("bot_errors_total", "Исключения в обработчиках по типу", ("type",))
+metrics.histogram("bot_event_loop_lag_seconds", "Опоздание пробуждения цикла событий относительно плана")
+
+def timed(name: str, callback):
+    """Оборачивает обработчик, записывая его время в гистограмму"""
+    labels = (name,)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        finally:
+            metrics.observe("bot_handler_duration_seconds", labels, time.perf_counter() - started)
+    return wrapper
+
+class LoopLagMonitor:
+    """Замер задержки цикла событий.
+
+    Фоновая задача засыпает на LOOP_LAG_INTERVAL и смотрит, насколько позже
+    она проснулась. Опоздание означает, что какой-то обработчик выполнял
+    блокирующую работу и не отдавал управление циклу.
+    """
+
+    def __init__(self, interval: float, warn: float):
+        self.interval = interval
+        self.warn = warn
+        self.last = 0.0
+        self.max = 0.0
+        self.stalls = 0
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(), name="loop-lag")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            lag = max(loop.time() - started - self.interval, 0.0)
+            metrics.observe("bot_event_loop_lag_seconds", (), lag)
+            self.last = lag
+            if lag > self.max:
+                self.max = lag
+            if lag > self.warn:
+                self.stalls += 1
+                logger.warning(f"🐢 Цикл событий был заблокирован на {lag * 1000:.0f} мс")
+
+    def stats(self) -> dict:
+        return {
+            "lag_ms": round(self.last * 1000, 2),
+            "max_lag_ms": round(self.max * 1000, 2),
+            "stalls": self.stalls,
+        }
+
+loop_lag = LoopLagMonitor(LOOP_LAG_INTERVAL, LOOP_LAG_WARN)
+
+# ===== ОГРАНИЧЕНИЕ ИСХОДЯЩИХ ЗАПРОСОВ =====
+class TokenBucket:
+    """Корзина токенов с резервированием: запрос забирает токен сразу, даже в долг,
+    и ждет ровно столько, сколько нужно для его восстановления"""
+
+    __slots__ = ("rate", "capacity", "tokens", "stamp")
+
+    def __init__(self, rate: float, capacity: float, now: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.stamp = now
+
+    def reserve(self, now: float) -> float:
+        """Забирает токен и возвращает, сколько секунд подождать перед запросом"""
+        self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def refund(self):
+        """Возвращает токен запроса, который так и не был выполнен"""
+        self.tokens += 1
+
+    def idle(self, now: float) -> bool:
+        """Корзина полностью восстановилась и ее можно забыть"""
+        return self.tokens + (now - self.stamp) * self.rate >= self.capacity
+
+
+class SendScheduler(BaseRateLimiter[dict]):
+    """Планировщик исходящих запросов к Bot API.
+
+    Новые сообщения (send*, copy*, forward*) сначала ждут свой слот в
+    корзине чата, затем все ограничиваемые запросы встают в общую очередь с
+    приоритетами, которую разбирает глобальная корзина токенов. Ожидание
+    корзины чата идет внутри обработки обновления; если оно затягивается,
+    пул шардов уводит этот чат из шарда (ChatShardScheduler), и чужие чаты
+    не ждут. Редактирования и ответы на нажатия лимит чата не проходят. Ответы на нажатия (answerCallbackQuery) идут в общей очереди
+    первыми. После 429 вся отправка ставится на паузу на
+    retry_after секунд и запрос повторяется.
+
+    Приоритет можно задать явно: rate_limit_args={"priority": SendScheduler.PRIORITY_BULK}.
+    """
+
+    PRIORITY_ANSWER = 0
+    PRIORITY_REPLY = 1
+    PRIORITY_BULK = 2
+
+    # Лимиты Telegram распространяются только на методы, отправляющие что-то в чат
+    LIMITED_PREFIXES = ("send", "edit", "copy", "forward", "answer")
+    # Ответ на inline-запрос ничего не отправляет в чат и не должен занимать общий бюджет
+    UNLIMITED_ENDPOINTS = ("answerInlineQuery",)
+    # Лимит сообщений в один чат считается только для новых сообщений
+    CHAT_LIMITED_PREFIXES = ("send", "copy", "forward")
+    MAX_IDLE_BUCKETS = 10000
+
+    def __init__(self, global_rate: float, chat_rate: float, group_rate: float,
+                 chat_burst: int, max_retries: int):
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._global: Optional[TokenBucket] = None
+        self._chats: dict[object, TokenBucket] = {}
+        self._waiting: list = []
+        self._seq = itertools.count()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._paused_until = 0.0
+        self._dispatcher: Optional[asyncio.Task] = None
+        # Статистика задержки, которую добавляет планировщик
+        self.sent = 0
+        self.retries = 0
+        self.delay_total = 0.0
+        self.delay_max = 0.0
+
+    async def initialize(self) -> None:
+        # Вызывается и из Bot.initialize, и из Application.initialize
+        if self._dispatcher is not None:
+            return
+        loop = asyncio.get_running_loop()
+        self._global = TokenBucket(self.global_rate, max(1.0, self.global_rate), loop.time())
+        self._wakeup = asyncio.Event()
+        self._dispatcher = asyncio.create_task(self._dispatch(), name="send-scheduler")
+
+    async def shutdown(self) -> None:
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            await asyncio.gather(self._dispatcher, return_exceptions=True)
+            self._dispatcher = None
+
+    def _priority(self, endpoint: str, rate_limit_args: Optional[dict]) -> Optional[int]:
+        """Приоритет запроса или None, если метод не ограничивается"""
+        if not endpoint.startswith(self.LIMITED_PREFIXES) or endpoint in self.UNLIMITED_ENDPOINTS:
+            return None
+        if rate_limit_args and "priority" in rate_limit_args:
+            return rate_limit_args["priority"]
+        if endpoint.startswith("answer"):
+            return self.PRIORITY_ANSWER
+        return self.PRIORITY_REPLY
+
+    def _chat_bucket(self, chat_id, now: float) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= self.MAX_IDLE_BUCKETS:
+                self._chats = {key: b for key, b in self._chats.items() if not b.idle(now)}
+            is_private = isinstance(chat_id, int) and chat_id > 0
+            bucket = TokenBucket(self.chat_rate if is_private else self.group_rate, self.chat_burst, now)
+            self._chats[chat_id] = bucket
+        return bucket
+
+    async def _acquire(self, priority: int):
+        """Ожидание слота в общей очереди"""
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiting, (priority, next(self._seq), future))
+        self._wakeup.set()
+        await future
+
+    async def _dispatch(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            if not self._waiting:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            now = loop.time()
+            if self._paused_until > now:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+            wait = self._global.reserve(now)
+            if wait:
+                await asyncio.sleep(wait)
+            # Берем самый приоритетный запрос уже после ожидания токена
+            _, _, future = heapq.heappop(self._waiting)
+            if not future.done():
+                future.set_result(None)
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        priority = self._priority(endpoint, rate_limit_args)
+        if priority is None:
+            return await self._call(endpoint, callback, args, kwargs)
+
+        loop = asyncio.get_running_loop()
+        chat_id = data.get("chat_id") if endpoint.startswith(self.CHAT_LIMITED_PREFIXES) else None
+        for attempt in range(self.max_retries + 1):
+            queued_at = loop.time()
+            if chat_id is not None:
+                wait = self._chat_bucket(chat_id, queued_at).reserve(queued_at)
+                if wait:
+                    await asyncio.sleep(wait)
+            await self._acquire(priority)
+            delay = loop.time() - queued_at
+            metrics.observe("bot_api_queue_delay_seconds", (endpoint,), delay)
+            self.sent += 1
+            self.delay_total += delay
+            if delay > self.delay_max:
+                self.delay_max = delay
+            try:
+                result = await self._call(endpoint, callback, args, kwargs)
+            except RetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                self.retries += 1
+                self._paused_until = max(self._paused_until, loop.time() + float(e.retry_after))
+                logger.warning(f"Flood control на {endpoint}: пауза {e.retry_after} с, попытка {attempt + 1}")
+                continue
+            boot.mark_reply()
+            return result
+
+    @property
+    def waiting(self) -> int:
+        """Сколько запросов ждут слота в общей очереди"""
+        return len(self._waiting)
+
+    @staticmethod
+    async def _call(endpoint: str, callback, args, kwargs):
+        started = time.perf_counter()
+        try:
+            return await callback(*args, **kwargs)
+        finally:
+            metrics.observe("bot_api_request_duration_seconds", (endpoint,), time.perf_counter() - started)
+
+    def stats(self) -> dict:
+        """Счетчики для эндпоинта /stats"""
+        return {
+            "sent": self.sent,
+            "waiting": self.waiting,
+            "retries": self.retries,
+            "queue_delay_avg_ms": round(self.delay_total / self.sent * 1000, 3) if self.sent else 0.0,
+            "queue_delay_max_ms": round(self.delay_max * 1000, 3),
+        }
+
+send_scheduler = SendScheduler(
+    BOT_API_GLOBAL_RATE, BOT_API_CHAT_RATE, BOT_API_GROUP_RATE, BOT_API_CHAT_BURST, BOT_API_MAX_RETRIES
+)
 
 # Создаем приложение Telegram
-application = Application.builder().token(TOKEN).build()
+application = (
+    Application.builder()
+    .token(TOKEN)
+    .base_url(BOT_API_BASE_URL)
+    .rate_limiter(send_scheduler)
+    .build()
+)
+
+# ===== ХРАНИЛИЩЕ ПОЛЬЗОВАТЕЛЕЙ =====
+@dataclass(slots=True)
+class UserRecord:
+    """Данные пользователя, которые хранятся в памяти и в SQLite"""
+    user_id: int
+    first_seen: float
+    last_seen: float
+    books: int = 0
+    programs: int = 0
+    resources: int = 0
+    blocked: bool = False  # пользователь заблокировал бота, рассылка его пропускает
+
+    def as_row(self) -> tuple:
+        return (
+            self.user_id, self.first_seen, self.last_seen,
+            self.books, self.programs, self.resources, int(self.blocked),
+        )
+
+
+class UserStore:
+    """Хранилище пользователей: SQLite на диске, LRU-кэш и отложенная запись.
+
+    Обработчики работают только с памятью. Изменения копятся в буфере и
+    пишутся на диск одной транзакцией по таймеру или при накоплении
+    USER_FLUSH_BATCH записей. С диском работает отдельный поток.
+    """
+
+    def __init__(self, path: str, cache_size: int, flush_interval: float, flush_batch: int):
+        self.path = path
+        self.cache_size = cache_size
+        self.flush_interval = flush_interval
+        self.flush_batch = flush_batch
+        self._cache: OrderedDict[int, UserRecord] = OrderedDict()
+        self._dirty: dict[int, UserRecord] = {}
+        self._conn: Optional[sqlite3.Connection] = None
+        self._db_lock = threading.Lock()
+        self._flush_now: Optional[asyncio.Event] = None
+        self._flusher: Optional[asyncio.Task] = None
+        self._closing = False
+        self.flushes = 0
+
+    async def open(self):
+        """Открывает базу и запускает фоновую запись"""
+        await asyncio.to_thread(self._connect)
+        self._flush_now = asyncio.Event()
+        self._flusher = asyncio.create_task(self._flush_loop(), name="user-store-flush")
+
+    async def close(self):
+        """Останавливает фоновую запись, сбрасывает буфер и закрывает базу"""
+        if self._flusher is not None:
+            # Не отменяем запись посреди flush(): буфер уже очищен, и пачка бы потерялась
+            self._closing = True
+            self._flush_now.set()
+            await asyncio.gather(self._flusher, return_exceptions=True)
+            self._flusher = None
+        await self.flush()
+        if self._conn is not None:
+            await asyncio.to_thread(self._disconnect)
+
+    def _disconnect(self):
+        # Ждем запросы, которые еще выполняются в других потоках
+        with self._db_lock:
+            self._conn.close()
+            self._conn = None
+
+    def _connect(self):
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS users ("
+            " user_id INTEGER PRIMARY KEY,"
+            " first_seen REAL NOT NULL,"
+            " last_seen REAL NOT NULL,"
+            " books INTEGER NOT NULL DEFAULT 0,"
+            " programs INTEGER NOT NULL DEFAULT 0,"
+            " resources INTEGER NOT NULL DEFAULT 0,"
+            " blocked INTEGER NOT NULL DEFAULT 0)"
+        )
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(users)")}
+        if "blocked" not in columns:
+            self._conn.execute("ALTER TABLE users ADD COLUMN blocked INTEGER NOT NULL DEFAULT 0")
+        self._conn.commit()
+
+    def _load(self, user_id: int) -> Optional[UserRecord]:
+        with self._db_lock:
+            row = self._conn.execute(
+                "SELECT user_id, first_seen, last_seen, books, programs, resources, blocked"
+                " FROM users WHERE user_id = ?",
+                (user_id,),
+            ).fetchone()
+        return UserRecord(*row[:6], blocked=bool(row[6])) if row else None
+
+    def _active_ids_after(self, cursor: int, limit: int) -> list[int]:
+        with self._db_lock:
+            rows = self._conn.execute(
+                "SELECT user_id FROM users WHERE user_id > ? AND blocked = 0 ORDER BY user_id LIMIT ?",
+                (cursor, limit),
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def _count_active_after(self, cursor: int) -> int:
+        with self._db_lock:
+            return self._conn.execute(
+                "SELECT COUNT(*) FROM users WHERE user_id > ? AND blocked = 0", (cursor,)
+            ).fetchone()[0]
+
+    def _set_blocked(self, user_ids: list[int]):
+        with self._db_lock, self._conn:
+            self._conn.executemany("UPDATE users SET blocked = 1 WHERE user_id = ?", [(i,) for i in user_ids])
+
+    def _write(self, rows: list[tuple]):
+        with self._db_lock, self._conn:
+            self._conn.executemany(
+                "INSERT INTO users (user_id, first_seen, last_seen, books, programs, resources, blocked)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)"
+                " ON CONFLICT(user_id) DO UPDATE SET"
+                " first_seen = MIN(first_seen, excluded.first_seen),"
+                " last_seen = excluded.last_seen,"
+                " books = excluded.books,"
+                " programs = excluded.programs,"
+                " resources = excluded.resources,"
+                " blocked = excluded.blocked",
+                rows,
+            )
+
+    def _cache_put(self, record: UserRecord):
+        self._cache[record.user_id] = record
+        self._cache.move_to_end(record.user_id)
+        if len(self._cache) > self.cache_size:
+            # Вытесненная запись с изменениями остается в буфере до записи на диск
+            self._cache.popitem(last=False)
+
+    def _mark_dirty(self, record: UserRecord):
+        self._dirty[record.user_id] = record
+        if len(self._dirty) >= self.flush_batch and self._flush_now is not None:
+            self._flush_now.set()
+
+    def peek(self, user_id: int) -> Optional[UserRecord]:
+        """Запись из памяти без обращения к диску"""
+        record = self._cache.get(user_id)
+        if record is not None:
+            self._cache.move_to_end(user_id)
+            return record
+        record = self._dirty.get(user_id)
+        if record is not None:
+            self._cache_put(record)
+        return record
+
+    async def get(self, user_id: int) -> Optional[UserRecord]:
+        """Запись пользователя; с диска читается только при промахе кэша"""
+        record = self.peek(user_id)
+        if record is not None:
+            return record
+        record = await asyncio.to_thread(self._load, user_id)
+        # Пока шло чтение, запись могла появиться в памяти
+        cached = self.peek(user_id)
+        if cached is not None:
+            return cached
+        if record is not None:
+            self._cache_put(record)
+        return record
+
+    async def touch(self, user_id: int, reachable: bool = True) -> UserRecord:
+        """Отмечает активность пользователя, создавая запись при первом появлении.
+
+        reachable=True снимает отметку о блокировке: так делается только для
+        сообщений и нажатий кнопок, после которых бот точно может писать.
+        """
+        now = time.time()
+        record = await self.get(user_id)
+        if record is None:
+            record = UserRecord(user_id, first_seen=now, last_seen=now)
+            self._cache_put(record)
+        record.last_seen = now
+        if reachable:
+            record.blocked = False
+        self._mark_dirty(record)
+        return record
+
+    def count_section(self, user_id: int, section: str):
+        """Увеличивает счетчик открытий раздела"""
+        record = self.peek(user_id)
+        if record is not None:
+            setattr(record, section, getattr(record, section) + 1)
+            self._mark_dirty(record)
+
+    async def active_ids_after(self, cursor: int, limit: int) -> list[int]:
+        """Страница id незаблокированных пользователей с id больше cursor"""
+        return await asyncio.to_thread(self._active_ids_after, cursor, limit)
+
+    async def count_active_after(self, cursor: int) -> int:
+        """Сколько незаблокированных пользователей с id больше cursor"""
+        return await asyncio.to_thread(self._count_active_after, cursor)
+
+    async def mark_blocked(self, user_ids: list[int]):
+        """Отмечает пользователей, заблокировавших бота"""
+        on_disk = []
+        for user_id in user_ids:
+            record = self._cache.get(user_id) or self._dirty.get(user_id)
+            if record is not None:
+                record.blocked = True
+                self._mark_dirty(record)
+            else:
+                on_disk.append(user_id)
+        if on_disk:
+            await asyncio.to_thread(self._set_blocked, on_disk)
+
+    async def flush(self):
+        """Записывает накопленные изменения одной транзакцией"""
+        if not self._dirty or self._conn is None:
+            return
+        records = list(self._dirty.values())
+        self._dirty = {}
+        try:
+            await asyncio.to_thread(self._write, [record.as_row() for record in records])
+        except Exception as e:
+            logger.error(f"Не удалось сохранить пользователей: {e}")
+            for record in records:
+                self._dirty.setdefault(record.user_id, record)
+            return
+        self.flushes += 1
+
+    async def _flush_loop(self):
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._flush_now.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_now.clear()
+            await self.flush()
+
+    def stats(self) -> dict:
+        """Счетчики для эндпоинта /stats"""
+        return {"cached": len(self._cache), "dirty": len(self._dirty), "flushes": self.flushes}
+
+user_store = UserStore(USER_DB_PATH, USER_CACHE_SIZE, USER_FLUSH_INTERVAL, USER_FLUSH_BATCH)
+
+# ===== КАТАЛОГ ССЫЛОК =====
+# Ссылки разделов хранятся в catalog.json. Из него один раз при запуске
+# собираются тексты меню /books, /programs, /resources и индекс для
+# поиска в inline-режиме.
+
+@dataclass(frozen=True, slots=True)
+class CatalogEntry:
+    """Одна ссылка каталога"""
+    section: str
+    group: str
+    title: str
+    url: str
+    description: str = ""
+    note: str = ""  # пометка в скобках, например «требуется регистрация»
+
+    def html(self) -> str:
+        """Строка со ссылкой в том виде, в каком она показывается в меню"""
+        text = f"<a href='{html.escape(self.url)}'>{html.escape(self.title)}</a>"
+        if self.description:
+            text += f" - {html.escape(self.description)}"
+        if self.note:
+            text += f" ({html.escape(self.note)})"
+        return text
+
+
+def normalize(text: str) -> list[str]:
+    """Слова для поиска: нижний регистр, «ё» как «е», без знаков препинания"""
+    return re.findall(r"\w+", text.lower().replace("ё", "е"))
+
+
+def load_catalog(path: str) -> dict[str, dict]:
+    """Разделы каталога по ключу"""
+    with open(path, encoding="utf-8") as f:
+        return {section["key"]: section for section in json.load(f)["sections"]}
+
+
+def group_entries(section: dict, group: dict) -> list[CatalogEntry]:
+    return [
+        CatalogEntry(
+            section["key"], group.get("name", ""), item["title"], item["url"],
+            item.get("description", ""), item.get("note", ""),
+        )
+        for item in group["entries"]
+    ]
+
+
+def section_text(section: dict) -> str:
+    """Текст меню раздела: заголовок, группы ссылок и примечание"""
+    blocks = [section["title"]]
+    for group in section["groups"]:
+        lines = [f"{group['icon']} <b>{html.escape(group['name'])}:</b>"] if group.get("name") else []
+        lines.extend(f"• {entry.html()}" for entry in group_entries(section, group))
+        blocks.append("\n".join(lines))
+    if section.get("footer"):
+        blocks.append(section["footer"])
+    return "\n\n".join(blocks)
+
+
+class CatalogIndex:
+    """Поиск по каталогу для inline-режима.
+
+    Слова названий, описаний и групп лежат в отсортированном списке, и все
+    слова с нужным префиксом находятся двумя bisect; для коротких префиксов,
+    под которые подходит много слов, объединение записей посчитано заранее.
+    Записи, где все слова запроса найдены в названии, идут первыми. Слово
+    запроса, с которого не начинается ни одно слово каталога, ищется по
+    триграммам - так находятся опечатки. Готовые списки результатов
+    кэшируются по нормализованному запросу (LRU).
+    """
+
+    FUZZY_MIN_LENGTH = 5  # у более коротких слов триграммы совпадают почти с чем угодно
+    SHORT_PREFIX_LENGTH = 3  # префиксы не длиннее этого считаются заранее,
+    SHORT_PREFIX_WORDS = 32  # если под них подходит больше слов
+
+    def __init__(self, entries: list[CatalogEntry], cache_size: int):
+        self.entries = entries
+        self.cache_size = cache_size
+        self._cache: OrderedDict[str, tuple[int, ...]] = OrderedDict()
+        self._articles: dict[int, InlineQueryResultArticle] = {}
+        self._all = tuple(range(len(entries)))
+        self.hits = 0
+        self.misses = 0
+
+        words: dict[str, tuple[set[int], set[int]]] = {}
+        for i, entry in enumerate(entries):
+            for word in normalize(entry.title):
+                in_title, anywhere = words.setdefault(word, (set(), set()))
+                in_title.add(i)
+                anywhere.add(i)
+            for word in normalize(f"{entry.description} {entry.note} {entry.group}"):
+                words.setdefault(word, (set(), set()))[1].add(i)
+        self._words = sorted(words)
+        self._in_title = [words[word][0] for word in self._words]
+        self._anywhere = [words[word][1] for word in self._words]
+
+        self._prefixes: dict[str, tuple[set[int], set[int]]] = {}
+        for length in range(1, self.SHORT_PREFIX_LENGTH + 1):
+            for prefix, group in itertools.groupby(range(len(self._words)), key=lambda w: self._words[w][:length]):
+                group = list(group)
+                if len(prefix) == length and len(group) > self.SHORT_PREFIX_WORDS:
+                    self._prefixes[prefix] = self._union(group[0], group[-1] + 1)
+
+        self._word_grams = [frozenset(self.trigrams(word)) for word in self._words]
+        self._gram_words: dict[str, list[int]] = {}
+        for w, grams in enumerate(self._word_grams):
+            for gram in grams:
+                self._gram_words.setdefault(gram, []).append(w)
+
+    @staticmethod
+    def trigrams(word: str) -> set[str]:
+        padded = f" {word} "
+        return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+    def search(self, query: str) -> tuple[int, ...]:
+        """Номера подходящих записей по порядку выдачи"""
+        terms = normalize(query)
+        key = " ".join(terms)
+        found = self._cache.get(key)
+        if found is not None:
+            self.hits += 1
+            self._cache.move_to_end(key)
+            return found
+        self.misses += 1
+        found = self._search(terms) if terms else self._all
+        self._cache[key] = found
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return found
+
+    def _union(self, lo: int, hi: int) -> tuple[set[int], set[int]]:
+        """Записи слов self._words[lo:hi]: (в названии, где угодно)"""
+        return set().union(*self._in_title[lo:hi]), set().union(*self._anywhere[lo:hi])
+
+    def _prefix(self, term: str) -> tuple[set[int], set[int]]:
+        found = self._prefixes.get(term)
+        if found is not None:
+            return found
+        return self._union(bisect_left(self._words, term), bisect_left(self._words, term + "\uffff"))
+
+    def _similar_words(self, term: str) -> list[int]:
+        """Слова каталога, с которыми совпадает хотя бы половина триграмм слова запроса"""
+        grams = self.trigrams(term)
+        need = (len(grams) + 1) // 2
+        # У подходящего слова есть хотя бы одна из (len - need + 1) самых редких триграмм,
+        # поэтому кандидатов достаточно набрать только по ним
+        rare = sorted(grams, key=lambda gram: len(self._gram_words.get(gram, ())))[:len(grams) - need + 1]
+        candidates = set().union(*(self._gram_words.get(gram, ()) for gram in rare))
+        return [w for w in candidates if len(grams & self._word_grams[w]) >= need]
+
+    def _search(self, terms: list[str]) -> tuple[int, ...]:
+        in_title: Optional[set[int]] = None
+        anywhere: Optional[set[int]] = None
+        for term in terms:
+            term_title, term_anywhere = self._prefix(term)
+            if not term_anywhere and len(term) >= self.FUZZY_MIN_LENGTH:
+                # Ни одно слово каталога так не начинается - вероятно, опечатка
+                similar = self._similar_words(term)
+                term_title = set().union(*(self._in_title[w] for w in similar))
+                term_anywhere = set().union(*(self._anywhere[w] for w in similar))
+            in_title = term_title if in_title is None else in_title & term_title
+            anywhere = term_anywhere if anywhere is None else anywhere & term_anywhere
+            if not anywhere:
+                return ()
+        return tuple(sorted(in_title) + sorted(anywhere - in_title))
+
+    def article(self, i: int) -> InlineQueryResultArticle:
+        """Результат inline-запроса для записи; собирается один раз"""
+        article = self._articles.get(i)
+        if article is None:
+            entry = self.entries[i]
+            article = InlineQueryResultArticle(
+                id=str(i),
+                title=entry.title,
+                url=entry.url,
+                description=entry.description or entry.note or entry.group or None,
+                input_message_content=InputTextMessageContent(entry.html(), parse_mode=ParseMode.HTML),
+            )
+            self._articles[i] = article
+        return article
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self.entries),
+            "words": len(self._words),
+            "cached_queries": len(self._cache),
+            "cache_hits": self.hits,
+            "cache_misses": self.misses,
+        }
+
+
+CATALOG = load_catalog(CATALOG_PATH)
+catalog_index = CatalogIndex(
+    [entry for section in CATALOG.values() for group in section["groups"] for entry in group_entries(section, group)],
+    INLINE_CACHE_SIZE,
+)
+
+# ===== РЕЕСТР МЕНЮ =====
+# Тексты и клавиатуры собираются один раз при запуске. Объекты Telegram
+# неизменяемы, поэтому одни и те же экземпляры переиспользуются во всех
+# обновлениях вместо того, чтобы строиться заново на каждое нажатие.
+
+@dataclass(frozen=True, slots=True)
+class Menu:
+    """Готовое меню: части текста, клавиатура и параметры отправки"""
+    parts: tuple[str, ...]
+    reply_markup: InlineKeyboardMarkup
+    disable_web_page_preview: Optional[bool] = None
+    section: Optional[str] = None  # раздел для счетчика в профиле
+
+    @classmethod
+    def from_template(cls, template: str, buttons, disable_web_page_preview=None, section=None):
+        """Разбивает шаблон по {user_name} заранее, чтобы не форматировать строку на каждом обновлении"""
+        return cls(
+            parts=tuple(template.split("{user_name}")),
+            reply_markup=InlineKeyboardMarkup(tuple((button,) for button in buttons)),
+            disable_web_page_preview=disable_web_page_preview,
+            section=section,
+        )
+
+    def render(self, user_name: str = "") -> str:
+        """Собирает текст меню с подстановкой имени пользователя"""
+        if len(self.parts) == 1:
+            return self.parts[0]
+        return user_name.join(self.parts)
+
+
+def get_user_name(update: Update) -> str:
+    """Имя пользователя для приветствия"""
+    user = update.effective_user
+    return (user.full_name if user else None) or "пользователь"
+
+
+BTN_BOOKS = InlineKeyboardButton("📚 Книжная библиотека", callback_data="/books")
+BTN_PROGRAMS = InlineKeyboardButton("💻 Программы для ПК", callback_data="/programs")
+BTN_RESOURCES = InlineKeyboardButton("🔗 Полезные ресурсы", callback_data="/resources")
+BTN_BOOKS_SHORT = InlineKeyboardButton("📚 Книги", callback_data="/books")
+BTN_PROGRAMS_SHORT = InlineKeyboardButton("💻 Программы", callback_data="/programs")
+BTN_RESOURCES_SHORT = InlineKeyboardButton("🔗 Ресурсы", callback_data="/resources")
+BTN_RESTART = InlineKeyboardButton("🔄 Перезапустить бота", callback_data="/start")
+BTN_MAIN_MENU = InlineKeyboardButton("🔄 Главное меню", callback_data="/start")
+
+START_MENU = Menu.from_template(
+    "🚀 Привет, {user_name}!\n"
+    "Я Средний Научный Бот канала <b>Республика Информация</b>, Фёдор Семёныч!🤖\n\n"
+    "Используйте команды:\n"
+    "/books - доступ к книжной библиотеке\n"
+    "/programs - программы для ПК\n"
+    "/resources - полезные ресурсы\n"
+    "/help - помощь по боту\n"
+    "/profile - ваш профиль\n\n"
+    "📢 Основной канал: @republic_inform",
+    (BTN_BOOKS, BTN_PROGRAMS, BTN_RESOURCES, BTN_RESTART),
+)
+
+BOOKS_MENU = Menu.from_template(
+    section_text(CATALOG["books"]),
+    (BTN_PROGRAMS, BTN_RESOURCES, BTN_MAIN_MENU),
+    disable_web_page_preview=True,
+    section="books",
+)
+
+PROGRAMS_MENU = Menu.from_template(
+    section_text(CATALOG["programs"]),
+    (BTN_BOOKS, BTN_RESOURCES, BTN_MAIN_MENU),
+    disable_web_page_preview=True,
+    section="programs",
+)
+
+RESOURCES_MENU = Menu.from_template(
+    section_text(CATALOG["resources"]),
+    (BTN_BOOKS, BTN_PROGRAMS, BTN_MAIN_MENU),
+    disable_web_page_preview=True,
+    section="resources",
+)
+
+HELP_MENU = Menu.from_template(
+    "ℹ️ <b>Помощь по боту Фёдор Семёныч</b>\n\n"
+    "📚 <u>Основные команды</u>:\n"
+    "/start - начать работу с ботом\n"
+    "/books - доступ к книжной библиотеке\n"
+    "/programs - программы для ПК\n"
+    "/resources - полезные ресурсы\n"
+    "/profile - ваш профиль\n"
+    "/settings - настройки бота\n\n"
+    "🔍 Поиск по ссылкам в любом чате: наберите имя бота и запрос\n\n"
+    "🔗 <u>Полезные ссылки</u>:\n"
+    "• Основной канал: @republic_inform\n"
+    "• Разработчик: @Alex_De_White\n"
+    "• Техническая поддержка: @Alex_De_White\n\n"
+    "💡 По всем вопросам обращайтесь к разработчику",
+    (BTN_BOOKS_SHORT, BTN_PROGRAMS_SHORT, BTN_RESOURCES_SHORT, BTN_RESTART),
+)
+
+SETTINGS_MENU = Menu.from_template(
+    "⚙️ <b>Настройки бота</b>\n\n"
+    "🔔 Уведомления: включены\n"
+    "🌐 Язык: русский\n"
+    "🛡️ Безопасность: стандартная\n\n"
+    "⚡ Дополнительные настройки в разработке",
+    (BTN_BOOKS_SHORT, BTN_PROGRAMS_SHORT, BTN_MAIN_MENU),
+)
+
+PROFILE_KEYBOARD = InlineKeyboardMarkup(((BTN_BOOKS_SHORT,), (BTN_PROGRAMS_SHORT,), (BTN_MAIN_MENU,)))
+
+# Меню, доступные по callback_data кнопок
+MENUS: dict[str, Menu] = {
+    "/start": START_MENU,
+    "/books": BOOKS_MENU,
+    "/programs": PROGRAMS_MENU,
+    "/resources": RESOURCES_MENU,
+}
+
+def count_section(update: Update, menu: Menu):
+    """Учитывает открытие раздела в профиле пользователя"""
+    if menu.section and update.effective_user:
+        user_store.count_section(update.effective_user.id, menu.section)
+
+async def reply_menu(update: Update, menu: Menu):
+    """Отправляет меню ответом на сообщение пользователя"""
+    count_section(update, menu)
+    text = menu.render(get_user_name(update))
+    message = await update.message.reply_html(
+        text,
+        reply_markup=menu.reply_markup,
+        disable_web_page_preview=menu.disable_web_page_preview,
+    )
+    menu_states.remember((message.chat_id, message.message_id), text)
+
+async def edit_menu(update: Update, menu: Menu):
+    """Показывает меню в сообщении, на кнопку которого нажал пользователь"""
+    await update.callback_query.edit_message_text(
+        menu.render(get_user_name(update)),
+        parse_mode=ParseMode.HTML,
+        reply_markup=menu.reply_markup,
+        disable_web_page_preview=menu.disable_web_page_preview,
+    )
+
+# ===== СОСТОЯНИЕ СООБЩЕНИЙ С МЕНЮ =====
+class MenuStateCache:
+    """Помнит, какой текст сейчас показан в сообщении (chat_id, message_id).
+
+    Повторное нажатие на кнопку уже открытого меню не тратит запрос к API.
+    После каждого редактирования сообщение на TAP_COALESCE_WINDOW секунд
+    переходит в окно склейки: нажатия в это время только запоминаются, а по
+    окончании окна выполняется одно редактирование к последнему выбранному меню.
+    """
+
+    def __init__(self, maxsize: int, window: float):
+        self.maxsize = maxsize
+        self.window = window
+        self.shown: OrderedDict[tuple[int, int], str] = OrderedDict()
+        self._pending: dict[tuple[int, int], tuple[Update, Menu]] = {}
+        self._cooling: set[tuple[int, int]] = set()
+        self.edits = 0
+        self.skipped = 0
+        self.coalesced = 0
+
+    def remember(self, key: tuple[int, int], text: str):
+        """Запоминает текст, показанный в сообщении"""
+        self.shown[key] = text
+        self.shown.move_to_end(key)
+        if len(self.shown) > self.maxsize:
+            self.shown.popitem(last=False)
+
+    async def show(self, update: Update, menu: Menu):
+        """Показывает меню в сообщении с нажатой кнопкой, если оно еще не показано"""
+        message = update.callback_query.message
+        if message is None:
+            # Сообщение из inline-режима: состояние неизвестно, просто редактируем
+            await edit_menu(update, menu)
+            count_section(update, menu)
+            return
+        key = (message.chat.id, message.message_id)
+        if key in self._cooling:
+            self._pending[key] = (update, menu)
+            self.coalesced += 1
+            return
+        if not await self._edit(update, key, menu):
+            return
+        self._cooling.add(key)
+        application.create_task(self._trailing_edit(key), update=update)
+
+    async def _edit(self, update: Update, key: tuple[int, int], menu: Menu) -> bool:
+        """Редактирует сообщение; False, если такое меню уже показано.
+
+        Открытие раздела засчитывается в профиль только при реальной смене
+        меню, а не на каждое пропущенное или склеенное нажатие.
+        """
+        text = menu.render(get_user_name(update))
+        if self.shown.get(key) == text:
+            self.skipped += 1
+            return False
+        try:
+            await edit_menu(update, menu)
+        except BadRequest as e:
+            # Сообщение изменили без нас (например, до перезапуска бота)
+            if "not modified" not in str(e).lower():
+                raise
+            self.skipped += 1
+        else:
+            self.edits += 1
+            count_section(update, menu)
+        self.remember(key, text)
+        return True
+
+    async def _trailing_edit(self, key: tuple[int, int]):
+        """Окно склейки: по его окончании показывает последнее выбранное меню"""
+        try:
+            while True:
+                await asyncio.sleep(self.window)
+                pending = self._pending.pop(key, None)
+                if pending is None:
+                    return
+                update, menu = pending
+                if not await self._edit(update, key, menu):
+                    return
+        finally:
+            self._cooling.discard(key)
+            self._pending.pop(key, None)
+
+    def stats(self) -> dict:
+        """Счетчики для эндпоинта /stats"""
+        return {
+            "tracked": len(self.shown),
+            "edits": self.edits,
+            "skipped": self.skipped,
+            "coalesced": self.coalesced,
+        }
+
+menu_states = MenuStateCache(MENU_STATE_SIZE, TAP_COALESCE_WINDOW)
+
+# ===== ЗАЩИТА ОТ ФЛУДА =====
+class FloodGuard:
+    """Ограничение частоты обновлений от одного пользователя до всех обработчиков.
+
+    У каждого пользователя своя корзина токенов: FLOOD_RATE обновлений в
+    секунду со всплеском до FLOOD_BURST. Лишнее обновление ждет токен, если
+    тот освободится не позже чем через FLOOD_MAX_DELAY секунд, иначе
+    отбрасывается. Ожидание задерживает остальные обновления этого чата,
+    поэтому по умолчанию лишнее сразу отбрасывается. На отброшенное нажатие
+    кнопки все равно уходит answer() с низшим приоритетом, чтобы у
+    пользователя не крутились часики. Inline-запросы не ограничиваются: они
+    приходят на каждое нажатие клавиши и обычно отвечаются из кэша. Смена
+    статуса бота в чате тоже пропускается, иначе блокировка бота могла бы
+    потеряться.
+    """
+
+    MAX_IDLE_USERS = 10000
+
+    def __init__(self, rate: float, burst: int, max_delay: float, exempt: list[int]):
+        self.rate = rate
+        self.burst = burst
+        self.max_delay = max_delay
+        self.exempt = frozenset(exempt)
+        self._buckets: dict[int, TokenBucket] = {}
+        self.delayed = 0
+        self.dropped = 0
+
+    def _bucket(self, user_id: int, now: float) -> TokenBucket:
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            if len(self._buckets) >= self.MAX_IDLE_USERS:
+                self._buckets = {key: b for key, b in self._buckets.items() if not b.idle(now)}
+            bucket = TokenBucket(self.rate, self.burst, now)
+            self._buckets[user_id] = bucket
+        return bucket
+
+    async def __call__(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        user = update.effective_user
+        if user is None or user.id in self.exempt or update.inline_query is not None:
+            return
+        if update.my_chat_member is not None:
+            return
+        now = asyncio.get_running_loop().time()
+        bucket = self._bucket(user.id, now)
+        wait = bucket.reserve(now)
+        if not wait:
+            return
+        if wait <= self.max_delay:
+            self.delayed += 1
+            await asyncio.sleep(wait)
+            return
+
+        # Отброшенное обновление не должно копить долг, иначе флуд продлевал бы блокировку
+        bucket.refund()
+        self.dropped += 1
+        if update.callback_query is not None:
+            try:
+                # Ответ на флуд не должен обгонять ответы остальным пользователям
+                await context.bot.answer_callback_query(
+                    update.callback_query.id,
+                    rate_limit_args={"priority": SendScheduler.PRIORITY_BULK},
+                )
+            except TelegramError as e:
+                logger.debug(f"Не удалось ответить на нажатие при флуде: {e}")
+        raise ApplicationHandlerStop
+
+    def stats(self) -> dict:
+        return {
+            "tracked_users": len(self._buckets),
+            "delayed": self.delayed,
+            "dropped": self.dropped,
+        }
+
+flood_guard = FloodGuard(FLOOD_RATE, FLOOD_BURST, FLOOD_MAX_DELAY, ADMIN_IDS)
 
 # ===== ОБРАБОТЧИКИ КОМАНД =====
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка команды /start с кнопкой перезапуска"""
-    user = update.effective_user
-    user_name = user.full_name or "пользователь"
-    
-    keyboard = [
-        [InlineKeyboardButton("📚 Книжная библиотека", callback_data="/books")],
-        [InlineKeyboardButton("💻 Программы для ПК", callback_data="/programs")],
-        [InlineKeyboardButton("🔗 Полезные ресурсы", callback_data="/resources")],
-        [InlineKeyboardButton("🔄 Перезапустить бота", callback_data="/start")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    await update.message.reply_html(
-        f"🚀 Привет, {user_name}!\n"
-        "Я Средний Научный Бот канала <b>Республика Информация</b>, Фёдор Семёныч!🤖\n\n"
-        "Используйте команды:\n"
-        "/books - доступ к книжной библиотеке\n"
-        "/programs - программы для ПК\n" 
-        "/resources - полезные ресурсы\n"
-        "/help - помощь по боту\n"
-        "/profile - ваш профиль\n\n"
-        "📢 Основной канал: @republic_inform",
-        reply_markup=reply_markup
-    )
+    await reply_menu(update, START_MENU)
 
 async def books(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка команды /books с HTML-ссылками"""
-    keyboard = [
-        [InlineKeyboardButton("💻 Программы для ПК", callback_data="/programs")],
-        [InlineKeyboardButton("🔗 Полезные ресурсы", callback_data="/resources")],
-        [InlineKeyboardButton("🔄 Главное меню", callback_data="/start")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    response_text = (
-        "📚 <b>Книжный раздел Республика</b>\n\n"
-        "• <a href='https://disk.yandex.ru/d/BX1xA5UCNxz3YA'>Основная библиотека</a> - 5000+ книг\n"
-        "• <a href='https://disk.yandex.ru/d/d5cAK6TBCJSa_Q'>Добавить новую книгу</a> (требуется регистрация)\n"
-        "• <a href='https://disk.yandex.ru/d/BX1xA5UCNxz3YA?sort=modified'>Новинки</a> - последние добавленные книги\n\n"
-        "🔐 <i>Для доступа к книгам требуется пароль от архива</i>\n"
-        "💡 Пароль можно получить в основном канале: @republic_inform"
-    )
-    await update.message.reply_html(response_text, 
-                                  reply_markup=reply_markup,
-                                  disable_web_page_preview=True)
+    await reply_menu(update, BOOKS_MENU)
 
 async def programs(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка команды /programs - программы для ПК"""
-    keyboard = [
-        [InlineKeyboardButton("📚 Книжная библиотека", callback_data="/books")],
-        [InlineKeyboardButton("🔗 Полезные ресурсы", callback_data="/resources")],
-        [InlineKeyboardButton("🔄 Главное меню", callback_data="/start")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    response_text = (
-        "💻 <b>Полезные программы для ПК</b>\n\n"
-        "• <a href='https://diakov.net/'>Diakov.net</a> - проверенные программы и репаки\n"
-        "• <a href='https://repack.me/'>Repack.me</a> - репаки игр и программ\n"
-        "• <a href='https://rutracker.org/'>RuTracker</a> - торрент-трекер\n"
-        "• <a href='https://www.softportal.com/'>SoftPortal</a> - софт портал\n\n"
-        "⚠️ <i>Скачивайте программы только из проверенных источников!</i>"
-    )
-    await update.message.reply_html(response_text, 
-                                  reply_markup=reply_markup,
-                                  disable_web_page_preview=True)
+    await reply_menu(update, PROGRAMS_MENU)
 
 async def resources(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка команды /resources - полезные ресурсы"""
-    keyboard = [
-        [InlineKeyboardButton("📚 Книжная библиотека", callback_data="/books")],
-        [InlineKeyboardButton("💻 Программы для ПК", callback_data="/programs")],
-        [InlineKeyboardButton("🔄 Главное меню", callback_data="/start")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    response_text = (
-        "🔗 <b>Полезные ресурсы</b>\n\n"
-        "🎓 <b>Образование:</b>\n"
-        "• <a href='https://stepik.org/'>Stepik</a> - онлайн-курсы\n"
-        "• <a href='https://openedu.ru/'>Открытое образование</a>\n"
-        "• <a href='https://arzamas.academy/'>Арзамас</a> - гуманитарные курсы\n\n"
-        "📚 <b>Книги:</b>\n"
-        "• <a href='https://flibusta.is/'>Флибуста</a> - электронная библиотека\n"
-        "• <a href='https://libgen.is/'>LibGen</a> - научная литература\n\n"
-        "💻 <b>IT и программирование:</b>\n"
-        "• <a href='https://github.com/'>GitHub</a> - код и проекты\n"
-        "• <a href='https://stackoverflow.com/'>Stack Overflow</a> - помощь программистам\n"
-        "• <a href='https://habr.com/'>Habr</a> - IT-сообщество\n\n"
-        "🛠️ <b>Инструменты:</b>\n"
-        "• <a href='https://notion.so/'>Notion</a> - организация работы\n"
-        "• <a href='https://trello.com/'>Trello</a> - управление проектами"
-    )
-    await update.message.reply_html(response_text, 
-                                  reply_markup=reply_markup,
-                                  disable_web_page_preview=True)
+    await reply_menu(update, RESOURCES_MENU)
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка команды /help с кнопкой перезапуска"""
-    keyboard = [
-        [InlineKeyboardButton("📚 Книги", callback_data="/books")],
-        [InlineKeyboardButton("💻 Программы", callback_data="/programs")],
-        [InlineKeyboardButton("🔗 Ресурсы", callback_data="/resources")],
-        [InlineKeyboardButton("🔄 Перезапустить бота", callback_data="/start")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    help_text = (
-        "ℹ️ <b>Помощь по боту Фёдор Семёныч</b>\n\n"
-        "📚 <u>Основные команды</u>:\n"
-        "/start - начать работу с ботом\n"
-        "/books - доступ к книжной библиотеке\n"
-        "/programs - программы для ПК\n"
-        "/resources - полезные ресурсы\n"
-        "/profile - ваш профиль\n"
-        "/settings - настройки бота\n\n"
-        "🔗 <u>Полезные ссылки</u>:\n"
-        "• Основной канал: @republic_inform\n"
-        "• Разработчик: @Alex_De_White\n"
-        "• Техническая поддержка: @Alex_De_White\n\n"
-        "💡 По всем вопросам обращайтесь к разработчику"
-    )
-    await update.message.reply_html(help_text, reply_markup=reply_markup)
+    await reply_menu(update, HELP_MENU)
 
 async def settings(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка команды /settings"""
-    keyboard = [
-        [InlineKeyboardButton("📚 Книги", callback_data="/books")],
-        [InlineKeyboardButton("💻 Программы", callback_data="/programs")],
-        [InlineKeyboardButton("🔄 Главное меню", callback_data="/start")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    await update.message.reply_html(
-        "⚙️ <b>Настройки бота</b>\n\n"
-        "🔔 Уведомления: включены\n"
-        "🌐 Язык: русский\n"
-        "🛡️ Безопасность: стандартная\n\n"
-        "⚡ Дополнительные настройки в разработке",
-        reply_markup=reply_markup
-    )
+    await reply_menu(update, SETTINGS_MENU)
 
 async def profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка команды /profile"""
     user = update.effective_user
     user_name = user.full_name or "пользователь"
     username = f"@{user.username}" if user.username else "не установлен"
-    
-    keyboard = [
-        [InlineKeyboardButton("📚 Книги", callback_data="/books")],
-        [InlineKeyboardButton("💻 Программы", callback_data="/programs")],
-        [InlineKeyboardButton("🔄 Главное меню", callback_data="/start")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    record = await user_store.get(user.id) or UserRecord(user.id, time.time(), time.time())
+    first_seen = datetime.fromtimestamp(record.first_seen, timezone.utc)
+    last_seen = datetime.fromtimestamp(record.last_seen, timezone.utc)
     
     profile_text = (
         f"👤 <b>Ваш профиль</b>\n\n"
         f"🆔 ID: <code>{user.id}</code>\n"
         f"👤 Имя: {user_name}\n"
         f"🔗 Username: {username}\n\n"
-        f"📅 Дата регистрации: 2025-08-10\n"
+        f"📅 Дата регистрации: {first_seen:%Y-%m-%d}\n"
+        f"🕒 Последняя активность: {last_seen:%Y-%m-%d %H:%M} UTC\n"
         f"⭐ Статус: стандартный пользователь\n\n"
-        f"📚 Книг скачано: 0\n"
+        f"📖 Открыто разделов:\n"
+        f"• книги: {record.books}\n"
+        f"• программы: {record.programs}\n"
+        f"• ресурсы: {record.resources}\n"
         f"🎁 Премиум: не активен"
     )
-    await update.message.reply_html(profile_text, reply_markup=reply_markup)
+    await update.message.reply_html(profile_text, reply_markup=PROFILE_KEYBOARD)
+
+async def track_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Отмечает активность пользователя перед основными обработчиками"""
+    user = update.effective_user
+    if user is None:
+        return
+    member = update.my_chat_member
+    if member is not None and member.chat.type == ChatType.PRIVATE:
+        # Пользователь остановил бота или снова запустил его в личном чате
+        blocked = member.new_chat_member.status == ChatMemberStatus.BANNED
+        await user_store.touch(user.id, reachable=not blocked)
+        if blocked:
+            await user_store.mark_blocked([user.id])
+        return
+    reachable = update.message is not None or update.callback_query is not None
+    await user_store.touch(user.id, reachable=reachable)
 
 # ===== ОБРАБОТЧИК КНОПОК =====
+def menu_callback(menu: Menu):
+    """Создает обработчик кнопки, открывающей заданное меню"""
+    async def callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        await menu_states.show(update, menu)
+    return callback
+
+# Таблица callback_data -> обработчик вместо цепочки if/elif
+CALLBACK_HANDLERS = {data: menu_callback(menu) for data, menu in MENUS.items()}
+
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка нажатий на in-line кнопки"""
     query = update.callback_query
-    await query.answer()
-    
-    if query.data == "/start":
-        user = update.effective_user
-        user_name = user.full_name or "пользователь"
-        
-        keyboard = [
-            [InlineKeyboardButton("📚 Книжная библиотека", callback_data="/books")],
-            [InlineKeyboardButton("💻 Программы для ПК", callback_data="/programs")],
-            [InlineKeyboardButton("🔗 Полезные ресурсы", callback_data="/resources")],
-            [InlineKeyboardButton("🔄 Перезапустить бота", callback_data="/start")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await query.edit_message_text(
-            f"🚀 Привет, {user_name}!\n"
-            "Я Средний Научный Бот канала <b>Республика Информация</b>, Фёдор Семёныч!🤖\n\n"
-            "Используйте команды:\n"
-            "/books - доступ к книжной библиотеке\n"
-            "/programs - программы для ПК\n"
-            "/resources - полезные ресурсы\n"
-            "/help - помощь по боту\n"
-            "/profile - ваш профиль\n\n"
-            "📢 Основной канал: @republic_inform",
-            parse_mode='HTML',
-            reply_markup=reply_markup
-        )
-    
-    elif query.data == "/books":
-        keyboard = [
-            [InlineKeyboardButton("💻 Программы для ПК", callback_data="/programs")],
-            [InlineKeyboardButton("🔗 Полезные ресурсы", callback_data="/resources")],
-            [InlineKeyboardButton("🔄 Главное меню", callback_data="/start")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        response_text = (
-            "📚 <b>Книжный раздел Республика</b>\n\n"
-            "• <a href='https://disk.yandex.ru/d/BX1xA5UCNxz3YA'>Основная библиотека</a> - 5000+ книг\n"
-            "• <a href='https://disk.yandex.ru/d/d5cAK6TBCJSa_Q'>Добавить новую книгу</a> (требуется регистрация)\n"
-            "• <a href='https://disk.yandex.ru/d/BX1xA5UCNxz3YA?sort=modified'>Новинки</a> - последние добавленные книги\n\n"
-            "🔐 <i>Для доступа к книгам требуется пароль от архива</i>\n"
-            "💡 Пароль можно получить в основном канале: @republic_inform"
-        )
-        await query.edit_message_text(
-            response_text,
-            parse_mode='HTML',
-            reply_markup=reply_markup,
-            disable_web_page_preview=True
-        )
-    
-    elif query.data == "/programs":
-        keyboard = [
-            [InlineKeyboardButton("📚 Книжная библиотека", callback_data="/books")],
-            [InlineKeyboardButton("🔗 Полезные ресурсы", callback_data="/resources")],
-            [InlineKeyboardButton("🔄 Главное меню", callback_data="/start")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        response_text = (
-            "💻 <b>Полезные программы для ПК</b>\n\n"
-            "• <a href='https://diakov.net/'>Diakov.net</a> - проверенные программы и репаки\n"
-            "• <a href='https://repack.me/'>Repack.me</a> - репаки игр и программ\n"
-            "• <a href='https://rutracker.org/'>RuTracker</a> - торрент-трекер\n"
-            "• <a href='https://www.softportal.com/'>SoftPortal</a> - софт портал\n\n"
-            "⚠️ <i>Скачивайте программы только из проверенных источников!</i>"
-        )
-        await query.edit_message_text(
-            response_text,
-            parse_mode='HTML',
-            reply_markup=reply_markup,
-            disable_web_page_preview=True
-        )
-    
-    elif query.data == "/resources":
-        keyboard = [
-            [InlineKeyboardButton("📚 Книжная библиотека", callback_data="/books")],
-            [InlineKeyboardButton("💻 Программы для ПК", callback_data="/programs")],
-            [InlineKeyboardButton("🔄 Главное меню", callback_data="/start")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        response_text = (
-            "🔗 <b>Полезные ресурсы</b>\n\n"
-            "🎓 <b>Образование:</b>\n"
-            "• <a href='https://stepik.org/'>Stepik</a> - онлайн-курсы\n"
-            "• <a href='https://openedu.ru/'>Открытое образование</a>\n"
-            "• <a href='https://arzamas.academy/'>Арзамас</a> - гуманитарные курсы\n\n"
-            "📚 <b>Книги:</b>\n"
-            "• <a href='https://flibusta.is/'>Флибуста</a> - электронная библиотека\n"
-            "• <a href='https://libgen.is/'>LibGen</a> - научная литература\n\n"
-            "💻 <b>IT и программирование:</b>\n"
-            "• <a href='https://github.com/'>GitHub</a> - код и проекты\n"
-            "• <a href='https://stackoverflow.com/'>Stack Overflow</a> - помощь программистам\n"
-            "• <a href='https://habr.com/'>Habr</a> - IT-сообщество\n\n"
-            "🛠️ <b>Инструменты:</b>\n"
-            "• <a href='https://notion.so/'>Notion</a> - организация работы\n"
-            "• <a href='https://trello.com/'>Trello</a> - управление проектами"
-        )
-        await query.edit_message_text(
-            response_text,
-            parse_mode='HTML',
-            reply_markup=reply_markup,
-            disable_web_page_preview=True
+    started = time.perf_counter()
+    handler = CALLBACK_HANDLERS.get(query.data)
+    try:
+        await query.answer()
+        if handler is not None:
+            await handler(update, context)
+    finally:
+        label = f"callback {query.data}" if handler is not None else "callback other"
+        metrics.observe("bot_handler_duration_seconds", (label,), time.perf_counter() - started)
+
+# ===== INLINE-РЕЖИМ =====
+async def inline_search(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Поиск по каталогу ссылок: @бот запрос. Следующие страницы Telegram запросит сам по next_offset"""
+    query = update.inline_query
+    try:
+        offset = max(int(query.offset or 0), 0)
+    except ValueError:
+        offset = 0
+    found = catalog_index.search(query.query)
+    page = found[offset:offset + INLINE_PAGE_SIZE]
+    end = offset + len(page)
+    await query.answer(
+        [catalog_index.article(i) for i in page],
+        cache_time=INLINE_CACHE_TIME,
+        next_offset=str(end) if end < len(found) else "",
+    )
+
+# ===== РАССЫЛКА =====
+class Broadcaster:
+    """Рассылка сообщения всем известным пользователям.
+
+    Пользователи перебираются по возрастанию id пачками по
+    BROADCAST_CONCURRENCY одновременных отправок. После каждой пачки курсор
+    и счетчики сохраняются в BROADCAST_STATE_PATH, поэтому после перезапуска
+    рассылка продолжается с места остановки (повторно может уйти не больше
+    одной пачки). Отправки идут с низшим приоритетом планировщика, чтобы не
+    задерживать ответы пользователям. Заблокировавшие бота помечаются и в
+    следующих рассылках пропускаются.
+    """
+
+    PAGE_SIZE = 1000
+
+    def __init__(self, state_path: str, concurrency: int, report_interval: float):
+        self.state_path = state_path
+        self.concurrency = concurrency
+        self.report_interval = report_interval
+        self.state: Optional[dict] = None
+        self._task: Optional[asyncio.Task] = None
+        self._run_started = 0.0
+        self._run_sent = 0
+        self._last_report = 0.0
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self, state: dict):
+        """Запускает рассылку с заданным состоянием"""
+        self.state = state
+        self._run_started = time.monotonic()
+        self._run_sent = state["sent"]
+        self._task = asyncio.create_task(self._run(), name="broadcast")
+
+    async def resume(self):
+        """Продолжает незавершенную рассылку после перезапуска"""
+        try:
+            with open(self.state_path, encoding="utf-8") as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.error(f"Не удалось прочитать состояние рассылки: {e}")
+            return
+        if not state.get("finished") and not state.get("cancelled"):
+            logger.info(f"📣 Продолжаем рассылку с пользователя {state['cursor']}")
+            self.start(state)
+
+    async def stop(self):
+        """Останавливает рассылку при выключении; она продолжится при следующем запуске"""
+        if self.running:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    async def cancel(self):
+        """Отменяет рассылку насовсем"""
+        await self.stop()
+        if self.state is not None and not self.state.get("finished"):
+            self.state["cancelled"] = True
+            await self._checkpoint()
+
+    async def _checkpoint(self):
+        await asyncio.to_thread(self._write_state, dict(self.state))
+
+    def _write_state(self, state: dict):
+        tmp_path = self.state_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(state, f, ensure_ascii=False)
+        os.replace(tmp_path, self.state_path)
+
+    async def _send(self, user_id: int) -> str:
+        """Отправляет сообщение одному пользователю и возвращает исход"""
+        state = self.state
+        rate_limit_args = {"priority": SendScheduler.PRIORITY_BULK}
+        try:
+            if state.get("message_id"):
+                await application.bot.copy_message(
+                    chat_id=user_id,
+                    from_chat_id=state["from_chat_id"],
+                    message_id=state["message_id"],
+                    rate_limit_args=rate_limit_args,
+                )
+            else:
+                await application.bot.send_message(
+                    chat_id=user_id,
+                    text=state["text"],
+                    parse_mode=ParseMode.HTML,
+                    rate_limit_args=rate_limit_args,
+                )
+        except Forbidden:
+            return "blocked"
+        except BadRequest as e:
+            if "chat not found" in str(e).lower():
+                return "blocked"
+            logger.warning(f"Рассылка: ошибка для {user_id}: {e}")
+            return "failed"
+        except TelegramError as e:
+            logger.warning(f"Рассылка: ошибка для {user_id}: {e}")
+            return "failed"
+        return "sent"
+
+    async def _run(self):
+        state = self.state
+        # Новые пользователи из буфера тоже должны попасть в рассылку
+        await user_store.flush()
+        try:
+            while True:
+                user_ids = await user_store.active_ids_after(state["cursor"], self.PAGE_SIZE)
+                if not user_ids:
+                    break
+                for i in range(0, len(user_ids), self.concurrency):
+                    chunk = user_ids[i:i + self.concurrency]
+                    results = await asyncio.gather(*(self._send(user_id) for user_id in chunk))
+                    blocked = [user_id for user_id, result in zip(chunk, results) if result == "blocked"]
+                    if blocked:
+                        await user_store.mark_blocked(blocked)
+                    state["sent"] += results.count("sent")
+                    state["failed"] += results.count("failed")
+                    state["blocked"] += len(blocked)
+                    state["cursor"] = chunk[-1]
+                    await self._checkpoint()
+                    if time.monotonic() - self._last_report >= self.report_interval:
+                        await self.report()
+            state["finished"] = True
+            await self._checkpoint()
+            await self.report()
+            logger.info(f"📣 Рассылка завершена: {self.summary(0)}")
+        except Exception as e:
+            logger.error(f"Рассылка остановлена из-за ошибки: {e}")
+
+    def summary(self, remaining: int) -> str:
+        """Строка с прогрессом рассылки"""
+        state = self.state
+        elapsed = time.monotonic() - self._run_started
+        rate = (state["sent"] - self._run_sent) / elapsed if elapsed > 0 else 0.0
+        return (
+            f"отправлено {state['sent']}, ошибок {state['failed']}, "
+            f"заблокировали бота {state['blocked']}, осталось {remaining}, "
+            f"скорость {rate:.1f} сообщ./с"
         )
 
+    async def report(self):
+        """Обновляет сообщение с прогрессом у администратора"""
+        self._last_report = time.monotonic()
+        state = self.state
+        remaining = 0 if state.get("finished") else await user_store.count_active_after(state["cursor"])
+        title = "✅ Рассылка завершена" if state.get("finished") else "📣 Идет рассылка"
+        try:
+            await application.bot.edit_message_text(
+                f"{title}\n{self.summary(remaining)}",
+                chat_id=state["report_chat_id"],
+                message_id=state["report_message_id"],
+            )
+        except TelegramError as e:
+            logger.debug(f"Не удалось обновить отчет о рассылке: {e}")
+
+broadcaster = Broadcaster(BROADCAST_STATE_PATH, BROADCAST_CONCURRENCY, BROADCAST_REPORT_INTERVAL)
+
+async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработка команды /broadcast (только для администраторов).
+
+    Ответом на сообщение - рассылает копию этого сообщения,
+    иначе - текст после команды.
+    """
+    message = update.message
+    if broadcaster.running:
+        await message.reply_text("📣 Рассылка уже идет. /broadcast_status - прогресс, /broadcast_cancel - отмена")
+        return
+
+    state = {"cursor": 0, "sent": 0, "failed": 0, "blocked": 0, "started": time.time()}
+    if message.reply_to_message:
+        state["from_chat_id"] = message.chat_id
+        state["message_id"] = message.reply_to_message.message_id
+    else:
+        parts = message.text_html.split(maxsplit=1)
+        if len(parts) < 2:
+            await message.reply_text(
+                "Использование: /broadcast текст сообщения\n"
+                "или ответьте командой /broadcast на сообщение, которое нужно разослать"
+            )
+            return
+        state["text"] = parts[1]
+
+    report = await message.reply_text("📣 Рассылка запускается...")
+    state["report_chat_id"] = report.chat_id
+    state["report_message_id"] = report.message_id
+    broadcaster.start(state)
+
+async def broadcast_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработка команды /broadcast_status"""
+    if broadcaster.state is None:
+        await update.message.reply_text("Рассылок еще не было")
+        return
+    state = broadcaster.state
+    remaining = 0 if state.get("finished") else await user_store.count_active_after(state["cursor"])
+    status = "идет" if broadcaster.running else "остановлена"
+    await update.message.reply_text(f"📣 Рассылка {status}: {broadcaster.summary(remaining)}")
+
+async def broadcast_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработка команды /broadcast_cancel"""
+    if not broadcaster.running:
+        await update.message.reply_text("Сейчас рассылка не идет")
+        return
+    await broadcaster.cancel()
+    await update.message.reply_text("⛔ Рассылка отменена")
+
 # ===== ОБРАБОТЧИК ОШИБОК =====
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE):
     """Логируем ошибки"""
-    logger.error(msg="Исключение при обработке команды:", exc_info=True)
+    logger.error(msg="Исключение при обработке команды:", exc_info=context.error)
+    metrics.inc("bot_errors_total", (type(context.error).__name__,))
     
     if update and isinstance(update, Update) and update.message:
         await update.message.reply_text(
@@ -315,64 +1594,963 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE):
             "Попробуйте еще раз или обратитесь к разработчику @Alex_De_White"
         )
 
+# ===== ПАРАЛЛЕЛЬНАЯ ОБРАБОТКА =====
+class ChatShardScheduler:
+    """Пул воркеров, между которыми обновления распределяются по id чата.
+
+    Каждому шарду соответствует своя очередь и ровно один воркер, поэтому
+    обновления одного чата обрабатываются строго по порядку, а разные чаты
+    обрабатываются параллельно.
+
+    Обновление, которое обрабатывается дольше detach_after секунд (обычно
+    оно ждет лимит своего чата на отправку), уводится из шарда в отдельную
+    задачу чата. Следующие обновления этого чата встают к ней в очередь,
+    сохраняя порядок, а воркер шарда переходит к чужим чатам. Очередь чата
+    ограничена глубиной шарда: когда она заполнена, воркер ждет ее, как
+    ждал бы заполненный шард.
+    """
+
+    def __init__(self, workers: int, queue_size: int, detach_after: float):
+        self.shards = [asyncio.Queue(queue_size) for _ in range(workers)]
+        self.queue_size = queue_size
+        self.detach_after = detach_after
+        self.processed = 0
+        self.detached = 0
+        self._tasks: list[asyncio.Task] = []
+        self._lanes: dict[int, deque] = {}
+        self._lane_tasks: dict[int, asyncio.Task] = {}
+
+    @staticmethod
+    def shard_key(update: Update) -> int:
+        """Ключ шардирования: чат, затем пользователь, затем само обновление"""
+        chat = update.effective_chat
+        if chat is not None:
+            return chat.id
+        user = update.effective_user
+        if user is not None:
+            return user.id
+        return update.update_id
+
+    async def submit(self, update: Update, on_done=None):
+        """Ставит обновление в очередь его шарда; ждет, если очередь заполнена"""
+        shard = self.shards[self.shard_key(update) % len(self.shards)]
+        await shard.put((update, on_done))
+
+    def depths(self) -> list[int]:
+        """Текущая глубина очереди каждого шарда"""
+        return [shard.qsize() for shard in self.shards]
+
+    def lanes(self) -> int:
+        """Сколько чатов сейчас обрабатывается вне шардов"""
+        return len(self._lanes)
+
+    def start(self):
+        """Запуск по одному воркеру на шард"""
+        for i, shard in enumerate(self.shards):
+            self._tasks.append(asyncio.create_task(self._worker(shard), name=f"shard-{i}"))
+
+    async def stop(self, timeout: float = SHARD_DRAIN_TIMEOUT):
+        """Остановка воркеров после того, как очереди шардов опустеют.
+
+        Получение обновлений к этому моменту уже остановлено, поэтому новых
+        элементов не появится. Ждем не дольше timeout, после чего оставшиеся
+        обновления бросаются: при long polling их подтвердит только
+        acknowledge(), а в режиме вебхука они остаются в журнале.
+        """
+        if self._tasks and timeout > 0:
+            try:
+                await asyncio.wait_for(self._drain(), timeout)
+            except asyncio.TimeoutError:
+                left = sum(self.depths()) + sum(len(lane) for lane in self._lanes.values())
+                logger.warning(f"Очереди шардов не опустели за {timeout} с, в очередях осталось {left}")
+        tasks = self._tasks + list(self._lane_tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._tasks.clear()
+
+    async def _drain(self):
+        await asyncio.gather(*(shard.join() for shard in self.shards))
+        # Очереди шардов пусты, новых задач чатов больше не появится
+        while self._lane_tasks:
+            await asyncio.wait(list(self._lane_tasks.values()))
+
+    async def _process(self, update: Update, on_done):
+        try:
+            await application.process_update(update)
+        except Exception as e:
+            logger.error(f"Ошибка при обработке обновления {update.update_id}: {e}")
+        # При отмене обновление не считается обработанным
+        self.processed += 1
+        if on_done is not None:
+            on_done()
+
+    async def _lane(self, key: int, task: asyncio.Task):
+        """Дорабатывает задержавшееся обновление чата и то, что пришло в чат после него"""
+        lane = self._lanes[key]
+        try:
+            await task
+            while lane:
+                await self._process(*lane.popleft())
+        finally:
+            del self._lanes[key]
+            del self._lane_tasks[key]
+
+    async def _worker(self, shard: asyncio.Queue):
+        while True:
+            update, on_done = await shard.get()
+            try:
+                key = self.shard_key(update)
+                lane = self._lanes.get(key)
+                if lane is not None and len(lane) >= self.queue_size:
+                    await asyncio.wait((self._lane_tasks[key],))
+                    lane = self._lanes.get(key)
+                if lane is not None:
+                    lane.append((update, on_done))
+                    continue
+                if not self.detach_after:
+                    await self._process(update, on_done)
+                    continue
+                task = asyncio.ensure_future(self._process(update, on_done))
+                try:
+                    done, _ = await asyncio.wait((task,), timeout=self.detach_after)
+                except asyncio.CancelledError:
+                    task.cancel()
+                    raise
+                if not done:
+                    self.detached += 1
+                    self._lanes[key] = deque()
+                    self._lane_tasks[key] = asyncio.create_task(self._lane(key, task), name=f"lane-{key}")
+            finally:
+                shard.task_done()
+
+scheduler = ChatShardScheduler(UPDATE_WORKERS, SHARD_QUEUE_SIZE, SHARD_DETACH_AFTER)
+
+# ===== ЖУРНАЛ ОБНОВЛЕНИЙ =====
+class JournalSegment:
+    """Файл журнала фиксированного размера, отображенный в память"""
+
+    def __init__(self, path: str, size: int):
+        self.path = path
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        if os.fstat(self._fd).st_size < size:
+            os.ftruncate(self._fd, size)
+        self.size = size
+        self.map = mmap.mmap(self._fd, size)
+        self.pos = 0
+        self.synced = 0
+        # Незавершенные обновления, чьи тела лежат в этом сегменте: номер -> (смещение, длина)
+        self.pending: dict[int, tuple[int, int]] = {}
+
+    def close(self):
+        self.map.close()
+        os.close(self._fd)
+
+class UpdateJournal:
+    """Журнал принятых вебхуков на диске для восстановления после перезапуска.
+
+    Тело обновления дописывается в сегмент до ответа Telegram, а после
+    обработки в журнал добавляется отметка о завершении. Ответы ждут общий
+    msync: все вебхуки, пришедшие, пока шел предыдущий сброс (и за
+    необязательное окно JOURNAL_SYNC_INTERVAL), сбрасываются одним вызовом. При запуске незавершенные обновления читаются из
+    журнала и обрабатываются повторно, то есть доставка - «хотя бы один раз».
+
+    Запись: crc32, длина тела, тип, номер обновления в журнале, тело.
+    Полностью обработанные старые сегменты удаляются, а если их больше
+    JOURNAL_MAX_SEGMENTS, незавершенные записи переносятся в текущий сегмент.
+    """
+
+    RECORD = struct.Struct("<IIBQ")
+    CHECKED = struct.Struct("<IBQ")  # часть заголовка, которую покрывает crc32
+    ACCEPT = 1
+    DONE = 2
+
+    def __init__(self, directory: str, segment_size: int, max_segments: int, sync_interval: float):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_segments = max_segments
+        self.sync_interval = sync_interval
+        self.recovered = 0
+        self._segments: list[JournalSegment] = []
+        self._owner: dict[int, JournalSegment] = {}  # номер -> сегмент с телом
+        self._next_seq = 0
+        self._next_index = 0
+        self._dir_dirty = False
+        self._waiters: list[asyncio.Future] = []
+        self._wakeup: Optional[asyncio.Event] = None
+        self._closing = False
+        self._task: Optional[asyncio.Task] = None
+        self.appended = 0
+        self.commits = 0
+        self.syncs = 0
+        self.moved = 0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.directory)
+
+    @property
+    def pending(self) -> int:
+        """Принятые, но еще не обработанные обновления"""
+        return len(self._owner)
+
+    def open(self) -> list[tuple[int, bytes]]:
+        """Читает сегменты с диска и возвращает незавершенные обновления.
+
+        Незавершенные записи сразу переписываются в новый сегмент, а старые
+        файлы удаляются, поэтому журнал после запуска содержит только их.
+        """
+        if not self.enabled:
+            return []
+        os.makedirs(self.directory, exist_ok=True)
+        names = sorted(name for name in os.listdir(self.directory) if name.endswith(".journal"))
+        accepted: dict[int, bytes] = {}
+        done: set[int] = set()
+        for name in names:
+            with open(os.path.join(self.directory, name), "rb") as f:
+                data = f.read()
+            for kind, seq, body in self._scan(data):
+                if kind == self.ACCEPT:
+                    accepted[seq] = body
+                else:
+                    done.add(seq)
+        if names:
+            self._next_index = int(names[-1].split(".")[0]) + 1
+        self._next_seq = max(max(accepted, default=-1), max(done, default=-1)) + 1
+
+        recovered = sorted((seq, body) for seq, body in accepted.items() if seq not in done)
+        self._rotate(0)
+        for seq, body in recovered:
+            self._accept(seq, body)
+        # Переписанные записи могли занять несколько новых сегментов: на диск уходят все,
+        # и только потом удаляются старые файлы
+        self._sync(self._dirty_ranges(), True)
+        self._dir_dirty = False
+        for name in names:
+            os.remove(os.path.join(self.directory, name))
+        if names:
+            self._sync([], True)
+        self.recovered = len(recovered)
+        if recovered:
+            logger.info(f"📒 В журнале найдено необработанных обновлений: {len(recovered)}")
+        return recovered
+
+    def _scan(self, data: bytes):
+        """Записи сегмента по порядку; чтение обрывается на пустом месте или битой записи"""
+        header = self.RECORD.size
+        pos = 0
+        while pos + header <= len(data):
+            crc, length, kind, seq = self.RECORD.unpack_from(data, pos)
+            end = pos + header + length
+            if kind not in (self.ACCEPT, self.DONE) or end > len(data):
+                return
+            body = data[pos + header:end]
+            if zlib.crc32(body, zlib.crc32(self.CHECKED.pack(length, kind, seq))) != crc:
+                return
+            yield kind, seq, body
+            pos = end
+
+    def _rotate(self, min_size: int):
+        """Начинает новый сегмент; предыдущие остаются до завершения их обновлений"""
+        path = os.path.join(self.directory, f"{self._next_index:08d}.journal")
+        self._next_index += 1
+        self._segments.append(JournalSegment(path, max(self.segment_size, min_size)))
+        self._dir_dirty = True
+
+    def _write(self, kind: int, seq: int, body: bytes = b"") -> tuple[JournalSegment, int]:
+        """Дописывает запись в текущий сегмент и возвращает его и смещение тела"""
+        size = self.RECORD.size + len(body)
+        segment = self._segments[-1]
+        if segment.pos + size > segment.size:
+            self._rotate(size)
+            segment = self._segments[-1]
+        start = segment.pos
+        crc = zlib.crc32(body, zlib.crc32(self.CHECKED.pack(len(body), kind, seq)))
+        self.RECORD.pack_into(segment.map, start, crc, len(body), kind, seq)
+        segment.map[start + self.RECORD.size:start + size] = body
+        segment.pos = start + size
+        return segment, start + self.RECORD.size
+
+    def _accept(self, seq: int, body: bytes):
+        segment, offset = self._write(self.ACCEPT, seq, body)
+        segment.pending[seq] = (offset, len(body))
+        self._owner[seq] = segment
+
+    def append(self, body: bytes) -> Optional[int]:
+        """Записывает тело принятого обновления; на диск оно попадет при commit()"""
+        if not self.enabled:
+            return None
+        seq = self._next_seq
+        self._next_seq += 1
+        self._accept(seq, body)
+        self.appended += 1
+        return seq
+
+    async def commit(self):
+        """Ждет, пока все записанное к этому моменту окажется на диске"""
+        if not self.enabled:
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        self._wakeup.set()
+        await waiter
+
+    def mark_done(self, seq: Optional[int]):
+        """Отмечает обновление обработанным; после перезапуска оно не повторится"""
+        segment = self._owner.pop(seq, None)
+        if segment is None:
+            return
+        del segment.pending[seq]
+        self._write(self.DONE, seq)
+        self._wakeup.set()
+
+    def start(self):
+        """Запуск фоновой групповой записи на диск"""
+        if not self.enabled or self._task is not None:
+            return
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._sync_loop(), name="journal-sync")
+
+    async def close(self):
+        """Последний сброс на диск; незавершенные обновления останутся для следующего запуска"""
+        if self._task is not None:
+            # Не отменяем задачу посреди msync, а даем ей закончить текущую группу
+            self._closing = True
+            self._wakeup.set()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if not self._segments:
+            return
+        await asyncio.to_thread(self._sync, self._dirty_ranges(), self._dir_dirty)
+        for waiter in self._waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+        self._waiters.clear()
+        self._drop_finished()
+        for segment in self._segments:
+            segment.close()
+        self._segments.clear()
+        logger.info(f"📒 Журнал закрыт, необработанных обновлений: {self.pending}")
+        self._owner.clear()
+
+    def _dirty_ranges(self) -> list[tuple[mmap.mmap, int, int]]:
+        """Диапазоны сегментов, записанные после прошлого сброса, с выравниванием по странице"""
+        ranges = []
+        for segment in self._segments:
+            if segment.pos > segment.synced:
+                start = segment.synced - segment.synced % mmap.PAGESIZE
+                ranges.append((segment.map, start, segment.pos - start))
+                segment.synced = segment.pos
+        return ranges
+
+    def _sync(self, ranges: list[tuple[mmap.mmap, int, int]], sync_dir: bool):
+        """Выполняется в отдельном потоке: msync измененных страниц и fsync каталога"""
+        for segment_map, start, length in ranges:
+            segment_map.flush(start, length)
+        if sync_dir:
+            fd = os.open(self.directory, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def _compact(self):
+        """Переносит незавершенные записи из сегментов сверх лимита в текущий"""
+        excess = len(self._segments) - 1 - self.max_segments
+        for segment in self._segments[:max(excess, 0)]:
+            for seq, (offset, length) in list(segment.pending.items()):
+                self._accept(seq, segment.map[offset:offset + length])
+                self.moved += 1
+            segment.pending.clear()
+
+    def _drop_finished(self):
+        """Удаляет старые сегменты без незавершенных обновлений.
+
+        Удаляются только сегменты с начала списка: отметки о завершении
+        в них относятся к записям в них самих или в еще более старых.
+        """
+        while len(self._segments) > 1 and not self._segments[0].pending:
+            segment = self._segments.pop(0)
+            segment.close()
+            os.remove(segment.path)
+
+    async def _sync_loop(self):
+        while not self._closing:
+            await self._wakeup.wait()
+            if self.sync_interval:
+                # Собираем в одну группу все записи за окно синхронизации
+                await asyncio.sleep(self.sync_interval)
+            self._wakeup.clear()
+            self._compact()
+            waiters, self._waiters = self._waiters, []
+            synced = [(segment, segment.synced) for segment in self._segments]
+            ranges = self._dirty_ranges()
+            sync_dir, self._dir_dirty = self._dir_dirty, False
+            try:
+                await asyncio.to_thread(self._sync, ranges, sync_dir)
+            except Exception as e:
+                logger.error(f"Не удалось записать журнал на диск: {e}")
+                # Несброшенные страницы повторятся при следующей синхронизации
+                for segment, position in synced:
+                    segment.synced = min(segment.synced, position)
+                self._dir_dirty = self._dir_dirty or sync_dir
+                for waiter in waiters:
+                    if not waiter.done():
+                        waiter.set_exception(e)
+                continue
+            for waiter in waiters:
+                if not waiter.done():
+                    waiter.set_result(None)
+            self.syncs += 1
+            self.commits += len(waiters)
+            # Перенесенные записи уже на диске, старые копии можно удалять
+            self._drop_finished()
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "segments": len(self._segments),
+            "disk_bytes": sum(segment.size for segment in self._segments),
+            "pending": self.pending,
+            "appended": self.appended,
+            "recovered": self.recovered,
+            "moved": self.moved,
+            "syncs": self.syncs,
+            "commits_per_sync": round(self.commits / self.syncs, 2) if self.syncs else None,
+        }
+
+journal = UpdateJournal(JOURNAL_DIR, JOURNAL_SEGMENT_SIZE, JOURNAL_MAX_SEGMENTS, JOURNAL_SYNC_INTERVAL)
+
+# ===== ПРИЕМ ВЕБХУКОВ =====
+def load_json_decoder(name: str):
+    """Выбор функции разбора JSON: orjson, если установлен, иначе стандартный json"""
+    if name == "json":
+        return json.loads
+    if name == "auto":
+        try:
+            import orjson
+        except ImportError:
+            return json.loads
+        return orjson.loads
+    return importlib.import_module(name).loads
+
+json_loads = load_json_decoder(JSON_DECODER)
+
+# Telegram присылает update_id первым полем, поэтому хватает начала тела
+UPDATE_ID_RE = re.compile(rb'"update_id"\s*:\s*(\d+)')
+
+def peek_update_id(body: bytes) -> Optional[int]:
+    """Достает update_id из сырого тела без разбора JSON"""
+    match = UPDATE_ID_RE.search(body, 0, 64)
+    return int(match.group(1)) if match else None
+
+class UpdateIdWindow:
+    """Окно последних update_id фиксированного размера.
+
+    Битовая карта на DEDUP_WINDOW бит, адресуемая по update_id по модулю
+    размера. При росте максимального id биты, перешедшие к новым id,
+    очищаются. Id старше окна считаются уже обработанными.
+    """
+
+    def __init__(self, size: int):
+        self.size = max(8, size - size % 8)
+        self.bits = bytearray(self.size // 8)
+        self.highest: Optional[int] = None
+
+    def __contains__(self, update_id: int) -> bool:
+        if self.highest is None or update_id > self.highest:
+            return False
+        if update_id <= self.highest - self.size:
+            return True
+        i = update_id % self.size
+        return bool(self.bits[i >> 3] & (1 << (i & 7)))
+
+    def add(self, update_id: int):
+        """Отмечает update_id как полученный"""
+        if self.highest is None:
+            self.highest = update_id
+        elif update_id > self.highest:
+            if update_id - self.highest >= self.size:
+                self.bits = bytearray(len(self.bits))
+            else:
+                for old in range(self.highest + 1, update_id):
+                    i = old % self.size
+                    self.bits[i >> 3] &= ~(1 << (i & 7)) & 0xFF
+            self.highest = update_id
+        elif update_id <= self.highest - self.size:
+            return
+        i = update_id % self.size
+        self.bits[i >> 3] |= 1 << (i & 7)
+
+class WebhookIngress:
+    """Ограниченная очередь сырых тел вебхуков.
+
+    Эндпоинт только кладет байты в очередь (и в журнал) и отвечает Telegram,
+    а разбор JSON и создание Update выполняют фоновые воркеры.
+    """
+
+    def __init__(self, maxsize: int, workers: int, overflow: str, dedup_window: int):
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize)
+        self.workers = workers
+        self.overflow = overflow
+        self.recent = UpdateIdWindow(dedup_window)
+        self.rejected = 0
+        self.duplicates = 0
+        self.accepted = 0
+        self.shed = 0
+        self.decode_errors = 0
+        self._restored: list[tuple[int, bytes]] = []
+        self._tasks: list[asyncio.Task] = []
+
+    def offer(self, body: bytes) -> bool:
+        """Кладет тело запроса в очередь, не дожидаясь места, и дописывает его в журнал"""
+        if self.queue.full():
+            self.shed += 1
+            if self.shed % 100 == 1:
+                logger.warning(f"Очередь вебхуков заполнена ({self.queue.maxsize}), отброшено обновлений: {self.shed}")
+            return False
+        self.queue.put_nowait((journal.append(body), body))
+        self.accepted += 1
+        return True
+
+    def restore(self, items: list[tuple[int, bytes]]):
+        """Обновления из журнала: сразу считаются принятыми, в очередь встают при запуске"""
+        for seq, body in items:
+            update_id = peek_update_id(body)
+            if update_id is not None:
+                self.recent.add(update_id)
+        self._restored = items
+
+    async def _refill(self, items: list[tuple[int, bytes]]):
+        # Восстановленные обновления ждут места в очереди, а не отбрасываются
+        for item in items:
+            await self.queue.put(item)
+
+    def start(self):
+        """Запуск воркеров разбора"""
+        if self._restored:
+            self._tasks.append(asyncio.create_task(self._refill(self._restored), name="ingress-restore"))
+            self._restored = []
+        for i in range(self.workers):
+            self._tasks.append(asyncio.create_task(self._worker(), name=f"ingress-{i}"))
+
+    async def stop(self):
+        """Остановка воркеров; необработанные тела остаются в очереди"""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+
+    async def _worker(self):
+        while True:
+            seq, body = await self.queue.get()
+            try:
+                update = Update.de_json(json_loads(body), application.bot)
+                await scheduler.submit(update, partial(journal.mark_done, seq) if seq is not None else None)
+            except Exception as e:
+                self.decode_errors += 1
+                # Битое тело не разберется и после перезапуска
+                journal.mark_done(seq)
+                logger.error(f"Не удалось разобрать обновление: {e}")
+            finally:
+                self.queue.task_done()
+
+ingress = WebhookIngress(INGRESS_QUEUE_SIZE, INGRESS_WORKERS, INGRESS_OVERFLOW, DEDUP_WINDOW)
+
+# ===== РЕЖИМ POLLING =====
+class UpdatePoller:
+    """Получение обновлений через long polling getUpdates.
+
+    Пачка передается в пул шардов без ожидания обработки, и пока она
+    обрабатывается, уже идет запрос следующей (двойная буферизация). Запрос
+    с offset = последний update_id + 1 подтверждает предыдущую пачку целиком,
+    поэтому следующий запрос делается только когда пачка перед текущей
+    полностью обработана: каждое обновление скачивается один раз, а
+    подтвержденными, но необработанными бывают обновления не больше чем
+    одной пачки. Поэтому при остановке пул шардов сначала дорабатывает свои
+    очереди (ChatShardScheduler.stop), и только потом последняя пачка
+    подтверждается до самого старого необработанного обновления, остальное
+    Telegram отдаст снова. Повторную выдачу отсекает общее окно update_id.
+    """
+
+    def __init__(self, batch_size: int, timeout: int):
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self._in_flight: set[int] = set()
+        self._current: set[int] = set()  # необработанные обновления последней, еще не подтвержденной пачки
+        self._highest = -1
+        self._confirmed: Optional[int] = None
+        self._progress: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self.batches = 0
+        self.received = 0
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self):
+        """Запуск цикла getUpdates"""
+        if self.running:
+            return
+        self._progress = asyncio.Event()
+        self._task = asyncio.create_task(self._run(), name="poller")
+
+    async def stop(self):
+        """Остановка цикла; подтверждение обработанного - в acknowledge()"""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def acknowledge(self):
+        """Подтверждает обработанные обновления последней пачки, как Updater при остановке.
+
+        Вызывается после остановки воркеров шардов, иначе обновления,
+        обработанные после последнего getUpdates, пришли бы повторно.
+        """
+        offset = self._offset()
+        if offset is None or offset == self._confirmed:
+            return
+        try:
+            await application.bot.get_updates(offset=offset, limit=1, timeout=0)
+            self._confirmed = offset
+        except TelegramError as e:
+            logger.warning(f"Не удалось подтвердить обновления при остановке: {e}")
+
+    def _offset(self) -> Optional[int]:
+        if self._current:
+            return min(self._current)
+        return self._highest + 1 if self._highest >= 0 else None
+
+    def _done(self, update_id: int, batch: set[int]):
+        self._in_flight.discard(update_id)
+        batch.discard(update_id)
+        self._progress.set()
+
+    async def _run(self):
+        delay = 1
+        previous: set[int] = set()
+        while True:
+            # Следующий запрос подтвердит текущую пачку, поэтому предыдущая должна быть обработана
+            while previous:
+                self._progress.clear()
+                await self._progress.wait()
+            offset = self._highest + 1 if self._highest >= 0 else None
+            try:
+                updates = await application.bot.get_updates(
+                    offset=offset,
+                    limit=self.batch_size,
+                    timeout=self.timeout,
+                    allowed_updates=Update.ALL_TYPES,
+                )
+            except TelegramError as e:
+                logger.error(f"Ошибка getUpdates: {e}, повтор через {delay} с")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 30)
+                continue
+            delay = 1
+            self.batches += 1
+            self._confirmed = offset
+
+            batch: set[int] = set()
+            fresh = [update for update in updates if update.update_id not in ingress.recent]
+            for update in updates:
+                self._highest = max(self._highest, update.update_id)
+            for update in fresh:
+                ingress.recent.add(update.update_id)
+                self._in_flight.add(update.update_id)
+                batch.add(update.update_id)
+            previous, self._current = self._current, batch
+            for update in fresh:
+                await scheduler.submit(update, on_done=partial(self._done, update.update_id, batch))
+            self.received += len(fresh)
+
+    def stats(self) -> dict:
+        """Счетчики для эндпоинта /stats"""
+        return {
+            "running": self.running,
+            "batches": self.batches,
+            "received": self.received,
+            "in_flight": len(self._in_flight),
+        }
+
+poller = UpdatePoller(POLL_BATCH_SIZE, POLL_TIMEOUT)
+
+async def use_polling():
+    """Переключение на получение обновлений через getUpdates"""
+    await application.bot.delete_webhook()
+    boot.webhook = "disabled"
+    poller.start()
+    logger.info("Режим получения обновлений: polling")
+
+async def use_webhook():
+    """Переключение на получение обновлений через вебхук"""
+    await poller.stop()
+    # Подтвержденная пачка дорабатывается шардами, которые продолжают работать;
+    # необработанные обновления последней пачки после setWebhook придут вебхуком
+    # и отсекутся окном update_id
+    await poller.acknowledge()
+    await set_webhook(force=True)
+    logger.info("Режим получения обновлений: webhook")
+
+async def mode_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработка команды /mode [webhook|polling] (только для администраторов)"""
+    current = "polling" if poller.running else "webhook"
+    target = context.args[0].lower() if context.args else None
+    if target not in ("webhook", "polling"):
+        await update.message.reply_text(f"Текущий режим: {current}\nИспользование: /mode webhook или /mode polling")
+        return
+    if target == current:
+        await update.message.reply_text(f"Режим {current} уже включен")
+        return
+    if target == "webhook" and not WEBHOOK_URL:
+        await update.message.reply_text("RENDER_EXTERNAL_URL не установлен, вебхук недоступен")
+        return
+    await (use_webhook() if target == "webhook" else use_polling())
+    await update.message.reply_text(f"✅ Режим переключен: {target}")
+
 # ===== ВЕБХУК ЭНДПОИНТЫ =====
 async def webhook(request: Request) -> Response:
     """Эндпоинт для вебхуков от Telegram"""
+    started = time.perf_counter()
     try:
-        data = await request.json()
-        update = Update.de_json(data, application.bot)
-        await application.update_queue.put(update)
-        return Response()
-    except Exception as e:
-        logger.error(f"Ошибка в вебхуке: {e}")
-        return Response(status_code=500)
+        # Чужие запросы отсекаются до чтения тела
+        secret = request.headers.get("x-telegram-bot-api-secret-token", "")
+        if not hmac.compare_digest(secret.encode("latin-1"), WEBHOOK_SECRET.encode()):
+            ingress.rejected += 1
+            return Response(status_code=403)
+
+        body = await request.body()
+        # Повторная доставка того же обновления подтверждается без обработки,
+        # но не раньше, чем первая копия окажется на диске
+        update_id = peek_update_id(body)
+        if update_id is not None and update_id in ingress.recent:
+            ingress.duplicates += 1
+            await journal.commit()
+            return Response()
+
+        if ingress.offer(body):
+            if update_id is not None:
+                ingress.recent.add(update_id)
+            # Подтверждаем только после того, как тело записано на диск
+            await journal.commit()
+            return Response()
+        if ingress.overflow != "reject":
+            return Response()
+        # Telegram повторит доставку позже, когда очередь разгрузится
+        return Response(status_code=503)
+    finally:
+        metrics.observe("bot_webhook_duration_seconds", (), time.perf_counter() - started)
 
 async def health_check(request: Request) -> PlainTextResponse:
     """Эндпоинт для проверки здоровья приложения (обязателен для Render)"""
     return PlainTextResponse("OK")
 
-async def set_webhook():
-    """Установка вебхука при запуске"""
-    if WEBHOOK_URL:
-        await application.bot.set_webhook(url=f"{WEBHOOK_URL}")
-        logger.info(f"Вебхук установлен: {WEBHOOK_URL}")
-    else:
+async def ready_check(request: Request) -> JSONResponse:
+    """Эндпоинт готовности: 200 только когда обновления действительно обрабатываются"""
+    return JSONResponse(boot.as_dict(), status_code=200 if boot.phase == "ready" else 503)
+
+async def stats(request: Request) -> JSONResponse:
+    """Эндпоинт с состоянием очередей"""
+    return JSONResponse({
+        "ingress": {
+            "queued": ingress.queue.qsize(),
+            "accepted": ingress.accepted,
+            "rejected_secret": ingress.rejected,
+            "duplicates": ingress.duplicates,
+            "shed": ingress.shed,
+            "decode_errors": ingress.decode_errors,
+        },
+        "shards": {
+            "depths": scheduler.depths(),
+            "processed": scheduler.processed,
+            "detached": scheduler.detached,
+            "lanes": scheduler.lanes(),
+        },
+        "polling": poller.stats(),
+        "outbound": send_scheduler.stats(),
+        "menus": menu_states.stats(),
+        "users": user_store.stats(),
+        "inline": catalog_index.stats(),
+        "flood": flood_guard.stats(),
+        "loop": loop_lag.stats(),
+        "journal": journal.stats(),
+    })
+
+async def set_webhook(force: bool = False):
+    """Установка вебхука при запуске.
+
+    Если Telegram уже отправляет обновления на наш адрес (с отпечатком
+    текущего секрета) и не получает отказов, повторный setWebhook не нужен.
+    """
+    if not WEBHOOK_URL:
+        boot.webhook = "disabled"
         logger.warning("RENDER_EXTERNAL_URL не установлен, вебхук не настроен")
+        return
+    if not force:
+        info = await application.bot.get_webhook_info()
+        # 403 остается страховкой на случай, если секрет все же разошелся
+        rejected = "403" in (info.last_error_message or "")
+        if info.url == WEBHOOK_URL and not rejected:
+            boot.webhook = "unchanged"
+            logger.info(f"Вебхук уже установлен: {WEBHOOK_URL}")
+            return
+    await application.bot.set_webhook(url=f"{WEBHOOK_URL}", secret_token=WEBHOOK_SECRET)
+    boot.webhook = "set"
+    logger.info(f"Вебхук установлен: {WEBHOOK_URL}")
+
+# Значения, которые уже хранятся в объектах, собираются только при запросе /metrics
+metrics.collected(
+    "bot_queue_depth", "gauge", "Глубина очередей обновлений", ("queue",),
+    lambda: [(("ingress",), ingress.queue.qsize()), (("outbound",), send_scheduler.waiting)]
+    + [((f"shard{i}",), depth) for i, depth in enumerate(scheduler.depths())],
+)
+metrics.collected(
+    "bot_webhook_requests_total", "counter", "Запросы к /webhook по исходу", ("outcome",),
+    lambda: [
+        (("accepted",), ingress.accepted),
+        (("duplicate",), ingress.duplicates),
+        (("rejected_secret",), ingress.rejected),
+        (("shed",), ingress.shed),
+        (("decode_error",), ingress.decode_errors),
+    ],
+)
+metrics.collected(
+    "bot_updates_processed_total", "counter", "Обработанные обновления", (),
+    lambda: [((), scheduler.processed)],
+)
+metrics.collected(
+    "bot_journal_pending", "gauge", "Принятые, но еще не обработанные обновления в журнале", (),
+    lambda: [((), journal.pending)],
+)
+metrics.collected(
+    "bot_journal_syncs_total", "counter", "Групповые сбросы журнала на диск", (),
+    lambda: [((), journal.syncs)],
+)
+metrics.collected(
+    "bot_throttled_updates_total", "counter", "Обновления сверх лимита пользователя по исходу", ("outcome",),
+    lambda: [(("delayed",), flood_guard.delayed), (("dropped",), flood_guard.dropped)],
+)
+metrics.collected(
+    "bot_api_retries_total", "counter", "Повторы запросов к Bot API после 429", (),
+    lambda: [((), send_scheduler.retries)],
+)
+metrics.collected(
+    "bot_menu_edits_total", "counter", "Редактирования меню по исходу", ("outcome",),
+    lambda: [
+        (("edited",), menu_states.edits),
+        (("skipped",), menu_states.skipped),
+        (("coalesced",), menu_states.coalesced),
+    ],
+)
+
+async def metrics_endpoint(request: Request) -> PlainTextResponse:
+    """Эндпоинт с метриками в текстовом формате Prometheus"""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
 
 # ===== РЕГИСТРАЦИЯ ОБРАБОТЧИКОВ =====
 def setup_handlers():
     """Регистрация всех обработчиков"""
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("books", books))
-    application.add_handler(CommandHandler("programs", programs))
-    application.add_handler(CommandHandler("resources", resources))
-    application.add_handler(CommandHandler("help", help_command))
-    application.add_handler(CommandHandler("settings", settings))
-    application.add_handler(CommandHandler("profile", profile))
+    # Флуд отсекается раньше всего остального, включая учет активности
+    application.add_handler(TypeHandler(Update, flood_guard), group=-2)
+    application.add_handler(TypeHandler(Update, track_user), group=-1)
+    application.add_handler(CommandHandler("start", timed("start", start)))
+    application.add_handler(CommandHandler("books", timed("books", books)))
+    application.add_handler(CommandHandler("programs", timed("programs", programs)))
+    application.add_handler(CommandHandler("resources", timed("resources", resources)))
+    application.add_handler(CommandHandler("help", timed("help", help_command)))
+    application.add_handler(CommandHandler("settings", timed("settings", settings)))
+    application.add_handler(CommandHandler("profile", timed("profile", profile)))
     application.add_handler(CallbackQueryHandler(button_handler))
+    application.add_handler(InlineQueryHandler(timed("inline", inline_search)))
+    # Рассылка доступна только администраторам из ADMIN_IDS
+    admins = filters.User(user_id=ADMIN_IDS)
+    application.add_handler(CommandHandler("broadcast", broadcast, filters=admins))
+    application.add_handler(CommandHandler("broadcast_status", broadcast_status, filters=admins))
+    application.add_handler(CommandHandler("broadcast_cancel", broadcast_cancel, filters=admins))
+    application.add_handler(CommandHandler("mode", mode_command, filters=admins))
     application.add_error_handler(error_handler)
 
 # ===== ЗАПУСК ПРИЛОЖЕНИЯ =====
+async def start_bot():
+    """Инициализация бота. Выполняется, когда HTTP-сервер уже принимает запросы:
+    вебхуки, пришедшие раньше, ждут в очереди приема"""
+    try:
+        await user_store.open()
+        await application.initialize()
+        await application.start()
+        scheduler.start()
+        ingress.start()
+
+        # Устанавливаем вебхук или запускаем polling
+        if BOT_MODE == "polling":
+            await use_polling()
+        else:
+            await set_webhook()
+        # Готовность - только когда обновления действительно поступают
+        boot.mark_ready()
+        await broadcaster.resume()
+    except Exception:
+        boot.phase = "failed"
+        logger.exception("Не удалось запустить бота")
+        # Останавливаем сервер, чтобы хостинг перезапустил процесс
+        signal.raise_signal(signal.SIGTERM)
+
+async def stop_bot():
+    """Остановка всех компонентов в порядке, обратном запуску"""
+    boot.phase = "stopping"
+    await poller.stop()
+    await broadcaster.stop()
+    await ingress.stop()
+    await scheduler.stop()
+    await poller.acknowledge()
+    if application.running:
+        await application.stop()
+    await application.shutdown()
+    await user_store.close()
+    await journal.close()
+    await loop_lag.stop()
+
+@asynccontextmanager
+async def lifespan(app: Starlette):
+    """Запуск бота в фоне и его остановка внутри жизненного цикла сервера.
+
+    Сервер начинает слушать порт сразу, не дожидаясь инициализации бота.
+    Остановка выполняется здесь, а не после serve(): по SIGTERM uvicorn
+    после своего завершения повторно посылает сигнал процессу, и код после
+    serve() не успел бы выполниться.
+    """
+    journal.start()
+    loop_lag.start()
+    startup = asyncio.create_task(start_bot(), name="bot-startup")
+    try:
+        yield
+    finally:
+        if not startup.done():
+            startup.cancel()
+        await asyncio.gather(startup, return_exceptions=True)
+        await stop_bot()
+
 async def main():
     """Основная функция запуска"""
-    logger.info("🔄 Инициализация бота с вебхуками...")
+    logger.info(f"🔄 Инициализация бота (режим {BOT_MODE})...")
     
     # Регистрируем обработчики
     setup_handlers()
-    
-    # Запускаем приложение
-    await application.initialize()
-    await application.start()
-    
-    # Устанавливаем вебхук
-    await set_webhook()
+
+    # Обновления, принятые до прошлой остановки, но не обработанные
+    ingress.restore(journal.open())
     
     # Создаем Starlette приложение
     starlette_app = Starlette(routes=[
         Route("/webhook", webhook, methods=["POST"]),
         Route("/healthcheck", health_check, methods=["GET"]),
+        Route("/ready", ready_check, methods=["GET"]),
+        Route("/stats", stats, methods=["GET"]),
+        Route("/metrics", metrics_endpoint, methods=["GET"]),
         Route("/", health_check, methods=["GET"]),  # Корневой путь тоже для health check
-    ])
+    ], lifespan=lifespan)
     
     # Запускаем сервер
     config = uvicorn.Config(
@@ -383,7 +2561,7 @@ async def main():
     )
     server = uvicorn.Server(config)
     
-    logger.info(f"🤖 Бот запущен на порту {PORT}. Ожидание вебхуков...")
+    logger.info(f"🤖 Бот запускается на порту {PORT}. Ожидание обновлений...")
     await server.serve()
 
 # ===== ТОЧКА ВХОДА =====